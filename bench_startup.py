@@ -0,0 +1,104 @@
+"""Cold-start benchmark: import time of server.py, time to first accepted request
+and the journal restore time the server reports on startup.
+
+    python bench_startup.py            # 10 запусков каждого замера
+    python bench_startup.py --runs 30
+
+Every run starts a fresh interpreter in an empty temporary directory, so the
+database, journal and checkpoint are created from scratch, like on a first
+start after deployment.
+"""
+import argparse
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def bench_import(workdir):
+    """Wall time of ``import server`` in a new interpreter, in seconds."""
+    code = ("import sys, time; sys.path.insert(0, %r); t = time.perf_counter(); "
+            "import server; print(time.perf_counter() - t)" % os.path.dirname(SERVER))
+    out = subprocess.run([sys.executable, "-c", code], cwd=workdir, check=True,
+                         capture_output=True, text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def bench_first_request(workdir, timeout=30.0):
+    """Seconds from process spawn until ``GET /`` answers 200, and the restore time.
+
+    The restore time comes from the ``restore_live_state: N ms`` line the
+    server writes to stderr; it is None if the line is missing.
+    """
+    port = free_port()
+    env = dict(os.environ, PORT=str(port))
+    # stderr в файл, а не в PIPE: лог запросов сервера не должен заполнить буфер канала
+    with tempfile.TemporaryFile(mode="w+", encoding="utf-8", errors="replace") as stderr:
+        started = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, SERVER], cwd=workdir, env=env,
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr)
+        try:
+            while time.perf_counter() - started < timeout:
+                if proc.poll() is not None:
+                    raise RuntimeError("server exited with code %d:\n%s"
+                                       % (proc.returncode, read_log(stderr)))
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                        if response.status == 200:
+                            elapsed = time.perf_counter() - started
+                            match = re.search(r"restore_live_state: ([\d.]+) ms", read_log(stderr))
+                            return elapsed, float(match.group(1)) / 1000 if match else None
+                except OSError:
+                    time.sleep(0.005)
+            raise RuntimeError("server did not answer within %.0f s:\n%s" % (timeout, read_log(stderr)))
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+def read_log(f):
+    f.seek(0)
+    return f.read()[-4000:]
+
+
+def report(name, samples):
+    print(f"{name}: median {statistics.median(samples) * 1000:.1f} ms, "
+          f"min {min(samples) * 1000:.1f} ms, max {max(samples) * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    imports, first_requests, restores = [], [], []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as workdir:
+            imports.append(bench_import(workdir))
+        with tempfile.TemporaryDirectory() as workdir:
+            first_request, restore = bench_first_request(workdir)
+            first_requests.append(first_request)
+            if restore is not None:
+                restores.append(restore)
+    report("import server", imports)
+    report("spawn -> first GET /", first_requests)
+    if restores:
+        report("restore_live_state", restores)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,31 @@
+"""Download the vendor libraries into static/vendor for offline venues.
+
+    python fetch_assets.py
+
+Run it once on a machine with internet access and commit/copy the files:
+server.py then serves them from /assets/<version>/... with precompressed
+variants instead of linking to the CDNs.
+"""
+import os
+import sys
+import urllib.request
+
+from vendor_assets import VENDOR_ASSETS
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+
+def main():
+    for filename, url in VENDOR_ASSETS.items():
+        path = os.path.join(STATIC_DIR, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=30) as response:
+            body = response.read()
+        with open(path, "wb") as f:
+            f.write(body)
+        print(f"{filename}: {len(body)} bytes from {url}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""Replay a trace recorded with TRACE_PATH against server.py in-process.
+
+    python replay_trace.py game_trace.log            # максимальная скорость
+    python replay_trace.py game_trace.log --speed 1  # в реальном времени
+
+The server runs on the in-memory storage with journaling and tracing off,
+one Flask/Socket.IO test client per recorded browser and socket.  Game codes
+and player tokens are random, so the values the replayed server hands out
+are mapped onto the recorded ones as they appear.  The replayed state is
+compared with every recorded ``snapshot`` and ``final`` record at the point
+where it was written; the last comparison is reported together with
+throughput.  Traces of a crashed server have no ``final`` record and are
+checked against their last snapshot.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+
+def load_trace(path):
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break  # оборванная последняя запись
+    return records
+
+
+def configure_environment(speed):
+    # Настройки должны быть выставлены до импорта server
+    os.environ["STORAGE_BACKEND"] = "memory"
+    os.environ["JOURNAL_PATH"] = ""
+    os.environ["TRACE_PATH"] = ""
+    os.environ["CLOCK_SYNC_INTERVAL"] = "3600"
+    if speed <= 0:
+        # Без таймеров исход не зависит от планировщика потоков; вёдра ограничения
+        # частоты живут по настенным часам, поэтому их решения берём из записей "throttled"
+        os.environ["RATE_LIMITS"] = "0"
+        # Разблокировку кнопки по таймеру применяем из записей "timer"
+        os.environ["SIGNAL_AUTO_UNLOCK_SECONDS"] = "0"
+        os.environ["BROADCAST_FRAME_MS"] = "0"
+        os.environ["BUZZER_ACCEPT_WINDOW_MS"] = "0"
+        os.environ["RESUME_GRACE_SECONDS"] = "0"
+
+
+def mark_throttled(records):
+    """Flag ``ws`` records the recorded server dropped in its rate limiter.
+
+    A ``throttled`` record follows the event it refers to, possibly after
+    records of other sockets, so it is matched to the latest earlier unmatched
+    event of the same socket and name.
+    """
+    for i, record in enumerate(records):
+        if record["kind"] != "throttled":
+            continue
+        for j in range(i - 1, -1, -1):
+            earlier = records[j]
+            if (earlier["kind"] == "ws" and earlier["sid"] == record["sid"]
+                    and earlier["event"] == record["event"] and not earlier.get("throttled")):
+                earlier["throttled"] = True
+                break
+
+
+class Replayer:
+    def __init__(self, server, deterministic):
+        self.server = server
+        # Таймеры и ограничение частоты выключены: их действия берём из трассы
+        self.deterministic = deterministic
+        self.browsers = {}  # { client: flask test client }
+        self.sockets = {}   # { recorded sid: socketio test client }
+        self.aliases = {}   # { записанное значение: значение при воспроизведении }
+        self.errors = []
+
+    def remap(self, value):
+        if isinstance(value, str):
+            return self.aliases.get(value, value)
+        if isinstance(value, dict):
+            return {self.remap(k): self.remap(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.remap(v) for v in value]
+        return value
+
+    def browser(self, client):
+        if client not in self.browsers:
+            self.browsers[client] = self.server.app.test_client()
+        return self.browsers[client]
+
+    def apply(self, record):
+        kind = record["kind"]
+        if kind == "connect":
+            client = record.get("client") or "sid:" + record["sid"]
+            self.sockets[record["sid"]] = self.server.socketio.test_client(
+                self.server.app, flask_test_client=self.browser(client), auth=record.get("auth"))
+        elif kind == "disconnect":
+            sock = self.sockets.pop(record["sid"], None)
+            if sock and sock.is_connected():
+                sock.disconnect()
+        elif kind == "ws":
+            if self.deterministic and record.get("throttled"):
+                return
+            sock = self.sockets.get(record["sid"])
+            if sock is None:
+                self.errors.append(f"t={record['t']}: event {record['event']} from unknown sid")
+                return
+            sock.emit(record["event"], self.remap(record.get("data")))
+        elif kind == "timer":
+            if self.deterministic and record.get("name") == "auto_unlock":
+                self.server.auto_unlock_signal(self.remap(record.get("code")))
+        elif kind == "http":
+            browser = self.browser(record.get("client"))
+            response = browser.post(record["path"], data=self.remap(record.get("form") or {}))
+            if response.status_code != record.get("status"):
+                self.errors.append(f"t={record['t']}: POST {record['path']} -> "
+                                   f"{response.status_code}, recorded {record.get('status')}")
+            self.learn(record.get("code"), self.server.current_game_code)
+            with browser.session_transaction() as sess:
+                self.learn(record.get("token"), sess.get("player_token"))
+
+    def learn(self, recorded, actual):
+        if recorded and actual and recorded not in self.aliases:
+            self.aliases[recorded] = actual
+
+
+def diff_states(expected, actual, path=""):
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        diffs = []
+        for key in sorted(set(expected) | set(actual)):
+            diffs += diff_states(expected.get(key), actual.get(key), f"{path}/{key}")
+        return diffs
+    return [] if expected == actual else [f"{path or '/'}: recorded {expected!r}, replayed {actual!r}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("trace")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="множитель скорости: 1 — реальное время, 0 — максимальная скорость")
+    args = parser.parse_args()
+
+    records = load_trace(args.trace)
+    configure_environment(args.speed)
+    import server
+
+    if args.speed <= 0:
+        mark_throttled(records)
+    replayer = Replayer(server, deterministic=args.speed <= 0)
+    checked = None  # (вид записи, расхождения) последней сверки
+    events = 0
+    started = time.perf_counter()
+    for record in records:
+        if record["kind"] in ("snapshot", "final"):
+            diffs = diff_states(replayer.remap(record["state"]), server.trace_state_snapshot())
+            checked = (record["kind"], diffs)
+            continue
+        if args.speed > 0:
+            delay = record["t"] / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        replayer.apply(record)
+        events += 1
+    server.broadcaster.flush(server.current_game_code)
+    elapsed = time.perf_counter() - started
+
+    print(f"{events} records in {elapsed:.3f} s ({events / elapsed if elapsed else 0:.0f} records/s)")
+    for error in replayer.errors:
+        print("  ERROR", error)
+
+    if checked is None:
+        print("No state snapshot in the trace; nothing to compare")
+        return 1 if replayer.errors else 0
+    kind, diffs = checked
+    label = "Final state" if kind == "final" else "State at the last snapshot"
+    if diffs:
+        print(f"{label} differs:")
+        for line in diffs:
+            print("  ", line)
+        return 1
+    print(f"{label} matches the recording")
+    return 1 if replayer.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,17 @@
-import json, random, string, os, uuid
-import sqlite3
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+import json, random, string, os, sys, uuid, threading, time, csv, io, atexit, functools, signal
+import gzip, hashlib, mimetypes
+from urllib.parse import quote
+from collections import Counter, OrderedDict, deque
+from flask import Flask, Response, has_request_context, make_response, render_template, request, redirect, url_for, session, flash, send_from_directory
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import safe_join, secure_filename
+from vendor_assets import VENDOR_ASSETS
+
+try:
+    import brotli  # необязательная зависимость: без неё отдаём только gzip
+except ImportError:
+    brotli = None
 
 app = Flask(__name__, template_folder='templates')
 app.secret_key = "secret"
@@ -10,36 +19,142 @@ app.wsgi_app = ProxyFix(app.wsgi_app)
 socketio = SocketIO(app, async_mode="threading")
 
 # Database configuration
-DATABASE = "game_data.db"
+DATABASE = os.environ.get("DATABASE", "game_data.db")
+# Хранилище: "sqlite" (файл DATABASE), "memory" (без диска) или "log"
+# (память + журнал записей в STORAGE_LOG_PATH; без пути — ничего не сохраняется)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+STORAGE_LOG_PATH = os.environ.get("STORAGE_LOG_PATH")
+
+# Экспорт результатов: колонки строки и размер пачки при потоковой выгрузке
+EXPORT_COLUMNS = ("game_code", "start_time", "end_time", "slot_id", "player_name",
+                  "round_number", "round_name", "round_score", "total_score",
+                  "final_bet", "final_bet_result")
+EXPORT_BATCH_SIZE = 500
+
+# Окно склейки исходящих рассылок в комнату (мс); 0 — отправлять сразу
+BROADCAST_FRAME_MS = int(os.environ.get("BROADCAST_FRAME_MS", "20"))
+
+# Компактный формат горячих событий; клиент запрашивает его при подключении
+WIRE_COMPACT = "c1"
+COMPACT_WIRE_ENABLED = os.environ.get("COMPACT_WIRE", "1") != "0"
+
+# Ограничение частоты входящих событий: событие -> (токенов в секунду, ёмкость ведра);
+# RATE_LIMITS=0 выключает (нужно воспроизведению трассы на максимальной скорости)
+RATE_LIMITS_ENABLED = os.environ.get("RATE_LIMITS", "1") != "0"
+RATE_LIMITS = {
+    "player_signal": (5.0, 5),
+    "request_admin_snapshot": (2.0, 4),
+    "update_player_score": (20.0, 40),
+}
+# Сколько пакетов может ждать отправки на сокет, прежде чем он считается медленным
+OUTBOUND_QUEUE_LIMIT = int(os.environ.get("OUTBOUND_QUEUE_LIMIT", "64"))
+
+# Возобновление сессии: сколько событий комнаты хранить для повтора и сколько
+# секунд ждать переподключения, прежде чем объявить игрока отключившимся
+ROOM_HISTORY_SIZE = int(os.environ.get("ROOM_HISTORY_SIZE", "256"))
+RESUME_GRACE_SECONDS = float(os.environ.get("RESUME_GRACE_SECONDS", "5"))
+
+# Журнал живого состояния (пустой путь отключает) и периодические снимки; по умолчанию
+# включён только с SQLite: хранилища в памяти не переживают перезапуск сами
+JOURNAL_PATH = os.environ.get("JOURNAL_PATH",
+                              "game_journal.log" if STORAGE_BACKEND == "sqlite" else "")
+CHECKPOINT_PATH = os.environ.get("CHECKPOINT_PATH", "game_checkpoint.json")
+CHECKPOINT_EVERY = int(os.environ.get("CHECKPOINT_EVERY", "200"))  # записей между снимками
+
+# Автоматическая разблокировка кнопки; 0 — без таймера (воспроизведение трассы
+# на максимальной скорости применяет записанные разблокировки само)
+SIGNAL_AUTO_UNLOCK_SECONDS = float(os.environ.get("SIGNAL_AUTO_UNLOCK_SECONDS", "10"))
+
+# Внешние библиотеки: VENDOR_ASSETS из vendor_assets.py (общий с fetch_assets.py)
+ASSET_MAX_AGE = 365 * 24 * 3600
+RENDER_CACHE_SIZE = 64
+
+# Запись входящих событий и POST-запросов для replay_trace.py (пустой путь — выключено);
+# снимок состояния пишется периодически, чтобы трасса годилась и после падения
+TRACE_PATH = os.environ.get("TRACE_PATH", "")
+TRACE_SNAPSHOT_SECONDS = float(os.environ.get("TRACE_SNAPSHOT_SECONDS", "30"))
+
+# Справедливость кнопки: синхронизация часов клиентов (NTP-подобный пинг) и окно
+# арбитража, в течение которого нажатия упорядочиваются по исправленному времени
+CLOCK_SYNC_INTERVAL = float(os.environ.get("CLOCK_SYNC_INTERVAL", "2"))
+CLOCK_SAMPLES = 8
+BUZZER_ACCEPT_WINDOW_MS = float(os.environ.get("BUZZER_ACCEPT_WINDOW_MS", "60"))  # 0 — побеждает первый пакет
+BUZZER_MAX_COMPENSATION_MS = float(os.environ.get("BUZZER_MAX_COMPENSATION_MS", "250"))
 
 # Separate valid slots (identifiers) from passwords
 valid_slots = ["1", "2", "3"]  # These are the slot identifiers
 passwords = ["11111", "22222", "33333"]  # These are the actual passwords for login
 
+# Раунды игры: номер раунда — индекс в списке (включая перестрелку)
+ROUND_NAMES = ["Раунд I", "Раунд II", "Раунд III", "Финальный раунд", "Перестрелка"]
+
+# Пакеты вопросов: каталоги PACKS_DIR/<имя>/pack.json с медиафайлами рядом;
+# относительный путь считается от каталога приложения, как static/ и templates/
+PACKS_DIR = os.path.join(app.root_path, os.environ.get("PACKS_DIR", "packs"))
+QUESTION_PACK = os.environ.get("QUESTION_PACK")  # пакет по умолчанию; иначе первый по имени
+MEDIA_MAX_AGE = 24 * 3600
+
 current_game_code = None
 game_state = {}  # { code: { "1": {"sid":..., "name":...} или None } }
 socket_registry = {}
+player_tokens = {}  # { code: { slot: token } } — для проверки при возобновлении без БД
+pending_leaves = {}  # { (code, slot): Timer } — отложенные отключения на время grace-периода
+selected_rounds = {}  # { code: {"round_number":..., "round_name":...} }
 
-def get_db_connection():
-    """Get a thread-safe database connection with proper settings."""
-    conn = sqlite3.connect(DATABASE, check_same_thread=False, timeout=20.0)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA synchronous=NORMAL;")
-    conn.execute("PRAGMA cache_size=1000;")
-    conn.execute("PRAGMA temp_store=MEMORY;")
-    return conn
+# ===== Хранилище =====
+class StorageBackend:
+    """Persistence interface used by the game code.
 
+    Rows are returned as plain tuples in the column order of the original
+    SQLite queries, so every backend is interchangeable for ``load_playerdata``
+    and the update helpers below.  Update methods follow the SQL semantics:
+    ``None`` means "keep the current value".
+    """
 
-def init_db():
-    """Initialize the SQLite database with required tables."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Drop the historical_games table if it exists (as requested)
-    cursor.execute("DROP TABLE IF EXISTS historical_games")
-    
-    # Create table for game sessions and player data
-    cursor.execute('''
+    def init_schema(self):
+        pass
+
+    def latest_session(self):
+        """Return ``(game_code, current_game_code, start_time, end_time)`` or None."""
+        raise NotImplementedError
+
+    def get_players(self, game_code):
+        """Return ``[(slot_id, name, token, connected, red_button_state), ...]``."""
+        raise NotImplementedError
+
+    def get_scores(self, game_code):
+        """Return ``[(slot_id, round_number, round_score, total_score), ...]``."""
+        raise NotImplementedError
+
+    def upsert_game_session(self, game_code, current_game_code, start_time, end_time):
+        raise NotImplementedError
+
+    def upsert_player(self, game_code, slot_id, name, token, connected, red_button_state):
+        raise NotImplementedError
+
+    def set_red_button_state(self, game_code, slot_id, red_button_state):
+        raise NotImplementedError
+
+    def upsert_score(self, game_code, slot_id, round_number, round_score, total_score,
+                     round_name, final_bet, final_bet_result):
+        raise NotImplementedError
+
+    def iter_export_rows(self, game_code=None, date_from=None, date_to=None):
+        """Yield one ``EXPORT_COLUMNS`` tuple per (game, slot, round) score row.
+
+        ``date_from``/``date_to`` are inclusive ``YYYY-MM-DD`` bounds on the
+        game start date (creation date for games that never started).
+        """
+        raise NotImplementedError
+
+
+# Версии схемы SQLite: миграция N переводит БД с user_version N-1 на N.
+# Миграции только добавляют (IF NOT EXISTS), поэтому безопасны и для старых
+# баз, созданных до появления версий (user_version = 0).
+SCHEMA_MIGRATIONS = [
+    # 1: исходные таблицы
+    [
+        '''
         CREATE TABLE IF NOT EXISTS game_sessions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             game_code TEXT UNIQUE,
@@ -48,10 +163,8 @@ def init_db():
             end_time TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # Create table for player data
-    cursor.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS players (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             game_code TEXT,
@@ -63,10 +176,8 @@ def init_db():
             FOREIGN KEY (game_code) REFERENCES game_sessions (game_code),
             UNIQUE (game_code, slot_id)
         )
-    ''')
-    
-    # Create table for scores
-    cursor.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS scores (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             game_code TEXT,
@@ -80,16 +191,400 @@ def init_db():
             FOREIGN KEY (game_code) REFERENCES game_sessions (game_code),
             UNIQUE (game_code, slot_id, round_number)
         )
-    ''')
-    
-    conn.commit()
-    conn.close()
+        ''',
+    ],
+    # 2: индекс по дню игры для выгрузки за период
+    [
+        "CREATE INDEX IF NOT EXISTS idx_game_sessions_day "
+        "ON game_sessions (substr(COALESCE(start_time, created_at), 1, 10))",
+    ],
+]
+
+
+def migrate_schema(conn):
+    """Apply pending ``SCHEMA_MIGRATIONS`` in one transaction; returns the new version."""
+    conn.isolation_level = None
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(SCHEMA_MIGRATIONS[version:], version + 1):
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(SCHEMA_MIGRATIONS)
+
+
+class SQLiteStorage(StorageBackend):
+    """The original on-disk storage: one SQLite file in WAL mode."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ready = False
+
+    def _open(self):
+        import sqlite3  # импорт и подготовка схемы откладываются до первого обращения
+        return sqlite3.connect(self.path, check_same_thread=False, timeout=20.0)
+
+    def connect(self):
+        """Get a thread-safe database connection with proper settings."""
+        if not self.ready:
+            self.init_schema()
+        conn = self._open()
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA cache_size=1000;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        return conn
+
+    def init_schema(self):
+        """Bring the schema up to date; runs once, on the first connection."""
+        if self.ready:
+            return
+        with self.lock:
+            if self.ready:
+                return
+            conn = self._open()
+            try:
+                # WAL сохраняется в файле БД, поэтому включается один раз здесь
+                conn.execute("PRAGMA journal_mode=WAL;")
+                migrate_schema(conn)
+            finally:
+                conn.close()
+            self.ready = True
+
+    def latest_session(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute("SELECT game_code, current_game_code, start_time, end_time FROM game_sessions ORDER BY id DESC LIMIT 1")
+        row = cursor.fetchone()
+        conn.close()
+        return row
+
+    def get_players(self, game_code):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute("SELECT slot_id, name, token, connected, red_button_state FROM players WHERE game_code = ?", (game_code,))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    def get_scores(self, game_code):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute("SELECT slot_id, round_number, round_score, total_score FROM scores WHERE game_code = ?", (game_code,))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    def upsert_game_session(self, game_code, current_game_code, start_time, end_time):
+        conn = self.connect()
+        cursor = conn.cursor()
+        
+        # Check if game session already exists
+        cursor.execute("SELECT id FROM game_sessions WHERE game_code = ?", (game_code,))
+        existing = cursor.fetchone()
+        
+        if existing:
+            # Update existing session
+            cursor.execute("""
+                UPDATE game_sessions 
+                SET current_game_code = COALESCE(?, current_game_code),
+                    start_time = COALESCE(?, start_time),
+                    end_time = COALESCE(?, end_time)
+                WHERE game_code = ?
+            """, (current_game_code, start_time, end_time, game_code))
+        else:
+            # Create new session
+            cursor.execute("""
+                INSERT INTO game_sessions (game_code, current_game_code, start_time, end_time)
+                VALUES (?, ?, ?, ?)
+            """, (game_code, current_game_code, start_time, end_time))
+        
+        conn.commit()
+        conn.close()
+
+    def set_red_button_state(self, game_code, slot_id, red_button_state):
+        conn = self.connect()
+        cursor = conn.cursor()
+        
+        # Update the red button state for the player
+        cursor.execute("""
+            UPDATE players 
+            SET red_button_state = ?
+            WHERE game_code = ? AND slot_id = ?
+        """, (red_button_state, game_code, slot_id))
+        
+        conn.commit()
+        conn.close()
+
+    def upsert_player(self, game_code, slot_id, name, token, connected, red_button_state):
+        conn = self.connect()
+        cursor = conn.cursor()
+        
+        # Check if player session already exists
+        cursor.execute("SELECT id FROM players WHERE game_code = ? AND slot_id = ?", (game_code, slot_id))
+        existing = cursor.fetchone()
+        
+        if existing:
+            # Update existing player
+            update_fields = []
+            params = []
+            
+            if name is not None:
+                update_fields.append("name = ?")
+                params.append(name)
+            if token is not None:
+                update_fields.append("token = ?")
+                params.append(token)
+            if connected is not None:
+                update_fields.append("connected = ?")
+                params.append(connected)
+            if red_button_state is not None:
+                update_fields.append("red_button_state = ?")
+                params.append(red_button_state)
+            
+            if update_fields:
+                sql = f"UPDATE players SET {', '.join(update_fields)} WHERE game_code = ? AND slot_id = ?"
+                params.extend([game_code, slot_id])
+                cursor.execute(sql, params)
+        else:
+            # Create new player
+            cursor.execute("""
+                INSERT INTO players (game_code, slot_id, name, token, connected, red_button_state)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (game_code, slot_id, name, token, connected or False, red_button_state or False))
+        
+        conn.commit()
+        conn.close()
+
+    def upsert_score(self, game_code, slot_id, round_number, round_score, total_score,
+                     round_name, final_bet, final_bet_result):
+        conn = self.connect()
+        cursor = conn.cursor()
+        
+        # Check if score record already exists
+        cursor.execute("SELECT id FROM scores WHERE game_code = ? AND slot_id = ? AND round_number = ?", 
+                       (game_code, slot_id, round_number))
+        existing = cursor.fetchone()
+        
+        if existing:
+            # Update existing score
+            cursor.execute("""
+                UPDATE scores 
+                SET round_score = COALESCE(?, round_score),
+                    total_score = COALESCE(?, total_score),
+                    round_name = COALESCE(?, round_name),
+                    final_bet = COALESCE(?, final_bet),
+                    final_bet_result = COALESCE(?, final_bet_result)
+                WHERE game_code = ? AND slot_id = ? AND round_number = ?
+            """, (round_score, total_score, round_name, final_bet, final_bet_result, game_code, slot_id, round_number))
+        else:
+            # Create new score record
+            cursor.execute("""
+                INSERT INTO scores (game_code, slot_id, round_number, round_name, round_score, total_score, final_bet, final_bet_result)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (game_code, slot_id, round_number, round_name, round_score or 0, total_score or 0, final_bet, final_bet_result))
+        
+        conn.commit()
+        conn.close()
+
+    def iter_export_rows(self, game_code=None, date_from=None, date_to=None):
+        # Отдельное соединение только для чтения: в режиме WAL чтение не мешает
+        # записи текущей игры, а строки забираются пачками, а не целиком
+        # В WHERE попадают только заданные фильтры: условие вида "? IS NULL OR ..."
+        # планировщик не сопоставляет с idx_game_sessions_day
+        day = "substr(COALESCE(g.start_time, g.created_at), 1, 10)"
+        where, params = [], []
+        if game_code is not None:
+            where.append("g.game_code = ?")
+            params.append(game_code)
+        if date_from is not None:
+            where.append(f"{day} >= ?")
+            params.append(date_from)
+        if date_to is not None:
+            where.append(f"{day} <= ?")
+            params.append(date_to)
+        # При выборке по датам строки идут в порядке индекса, без сортировки всей
+        # выгрузки во временном B-дереве до первой строки
+        order = f"{day}, g.id" if date_from is not None or date_to is not None else "g.id"
+        conn = self.connect()
+        try:
+            conn.execute("PRAGMA query_only = ON;")
+            cursor = conn.execute(f"""
+                SELECT g.game_code, g.start_time, g.end_time, s.slot_id, p.name,
+                       s.round_number, s.round_name, s.round_score, s.total_score,
+                       s.final_bet, s.final_bet_result
+                FROM game_sessions g
+                JOIN scores s ON s.game_code = g.game_code
+                LEFT JOIN players p ON p.game_code = s.game_code AND p.slot_id = s.slot_id
+                {"WHERE " + " AND ".join(where) if where else ""}
+                ORDER BY {order}, s.slot_id, s.round_number
+            """, params)
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+
+def _coalesce(row, **values):
+    """Apply ``values`` to ``row`` like SQL ``COALESCE(?, column)``."""
+    for column, value in values.items():
+        if value is not None:
+            row[column] = value
+
+
+class MemoryStorage(StorageBackend):
+    """Dict-based storage with no disk I/O, for tests, benchmarks and one-off nights."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}  # { game_code: row } в порядке создания, как id в SQLite
+        self.players = {}   # { game_code: { slot_id: row } }
+        self.scores = {}    # { game_code: { (slot_id, round_number): row } }
+
+    def latest_session(self):
+        with self.lock:
+            if not self.sessions:
+                return None
+            game_code = next(reversed(self.sessions))
+            row = self.sessions[game_code]
+            return (game_code, row["current_game_code"], row["start_time"], row["end_time"])
+
+    def get_players(self, game_code):
+        with self.lock:
+            return [(slot_id, row["name"], row["token"], row["connected"], row["red_button_state"])
+                    for slot_id, row in self.players.get(game_code, {}).items()]
+
+    def get_scores(self, game_code):
+        with self.lock:
+            return [(slot_id, round_number, row["round_score"], row["total_score"])
+                    for (slot_id, round_number), row in self.scores.get(game_code, {}).items()]
+
+    def upsert_game_session(self, game_code, current_game_code, start_time, end_time):
+        with self.lock:
+            row = self.sessions.setdefault(game_code, {
+                "current_game_code": None, "start_time": None, "end_time": None,
+                "created_at": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())})
+            _coalesce(row, current_game_code=current_game_code, start_time=start_time, end_time=end_time)
+
+    def upsert_player(self, game_code, slot_id, name, token, connected, red_button_state):
+        with self.lock:
+            slots = self.players.setdefault(game_code, {})
+            if slot_id not in slots:
+                slots[slot_id] = {"name": name, "token": token,
+                                  "connected": connected or False,
+                                  "red_button_state": red_button_state or False}
+                return
+            _coalesce(slots[slot_id], name=name, token=token, connected=connected,
+                      red_button_state=red_button_state)
+
+    def set_red_button_state(self, game_code, slot_id, red_button_state):
+        with self.lock:
+            row = self.players.get(game_code, {}).get(slot_id)
+            if row is not None:
+                row["red_button_state"] = red_button_state
+
+    def upsert_score(self, game_code, slot_id, round_number, round_score, total_score,
+                     round_name, final_bet, final_bet_result):
+        with self.lock:
+            rows = self.scores.setdefault(game_code, {})
+            key = (slot_id, round_number)
+            if key not in rows:
+                rows[key] = {"round_name": round_name, "round_score": round_score or 0,
+                             "total_score": total_score or 0, "final_bet": final_bet,
+                             "final_bet_result": final_bet_result}
+                return
+            _coalesce(rows[key], round_score=round_score, total_score=total_score,
+                      round_name=round_name, final_bet=final_bet, final_bet_result=final_bet_result)
+
+    def iter_export_rows(self, game_code=None, date_from=None, date_to=None):
+        with self.lock:
+            games = [(code, dict(row)) for code, row in self.sessions.items()
+                     if game_code is None or code == game_code]
+        for code, game in games:
+            day = (game["start_time"] or game["created_at"])[:10]
+            if (date_from and day < date_from) or (date_to and day > date_to):
+                continue
+            with self.lock:
+                names = {slot_id: row["name"] for slot_id, row in self.players.get(code, {}).items()}
+                scores = sorted((key, dict(row)) for key, row in self.scores.get(code, {}).items())
+            for (slot_id, round_number), row in scores:
+                yield (code, game["start_time"], game["end_time"], slot_id, names.get(slot_id),
+                       round_number, row["round_name"], row["round_score"], row["total_score"],
+                       row["final_bet"], row["final_bet_result"])
+
+
+class AppendLogStorage(MemoryStorage):
+    """In-memory storage that also appends every write to a JSON lines log.
+
+    Without a log path it is a null engine: the game works, nothing is kept
+    after the process exits.  Reads never touch the log.
+    """
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path
+        self.log_lock = threading.Lock()
+        self.file = None
+
+    def _append(self, op, **fields):
+        if not self.path:
+            return
+        fields["op"] = op
+        line = json.dumps(fields, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self.log_lock:
+            if self.file is None:
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write(line)
+            self.file.flush()
+
+    def upsert_game_session(self, game_code, current_game_code, start_time, end_time):
+        super().upsert_game_session(game_code, current_game_code, start_time, end_time)
+        self._append("game_session", game_code=game_code, current_game_code=current_game_code,
+                     start_time=start_time, end_time=end_time)
+
+    def upsert_player(self, game_code, slot_id, name, token, connected, red_button_state):
+        super().upsert_player(game_code, slot_id, name, token, connected, red_button_state)
+        self._append("player", game_code=game_code, slot_id=slot_id, name=name, token=token,
+                     connected=connected, red_button_state=red_button_state)
+
+    def set_red_button_state(self, game_code, slot_id, red_button_state):
+        super().set_red_button_state(game_code, slot_id, red_button_state)
+        self._append("red_button", game_code=game_code, slot_id=slot_id,
+                     red_button_state=red_button_state)
+
+    def upsert_score(self, game_code, slot_id, round_number, round_score, total_score,
+                     round_name, final_bet, final_bet_result):
+        super().upsert_score(game_code, slot_id, round_number, round_score, total_score,
+                             round_name, final_bet, final_bet_result)
+        self._append("score", game_code=game_code, slot_id=slot_id, round_number=round_number,
+                     round_score=round_score, total_score=total_score, round_name=round_name,
+                     final_bet=final_bet, final_bet_result=final_bet_result)
+
+
+def create_storage(name):
+    """Build the storage backend selected by ``STORAGE_BACKEND``."""
+    if name == "sqlite":
+        return SQLiteStorage(DATABASE)
+    if name == "memory":
+        return MemoryStorage()
+    if name == "log":
+        return AppendLogStorage(STORAGE_LOG_PATH)
+    raise ValueError(f"Unknown storage backend: {name!r}")
+
+
+storage = create_storage(STORAGE_BACKEND)
+
 
 def save_playerdata(data):
-    """Save player data to SQLite database."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+    """Save player data through the configured storage backend."""
     # Save current game code
     current_game_code = data.get("current_game_code")
     if current_game_code:
@@ -113,33 +608,20 @@ def save_playerdata(data):
     for slot_id, score_data in scores.items():
         if "rounds" in score_data and "total" in score_data:
             for round_num, round_score in enumerate(score_data["rounds"]):
-                # Define round names
-                round_names = ["Раунд I", "Раунд II", "Раунд III", "Финальный раунд", "Перестрелка"]
-                round_name = round_names[round_num] if round_num < len(round_names) else f"Раунд {round_num + 1}"
-                
                 update_score(
                     game_code=current_game_code,
                     slot_id=slot_id,
                     round_number=round_num,
                     round_score=round_score,
                     total_score=score_data["total"],
-                    round_name=round_name
+                    round_name=round_name(round_num)
                 )
-    
-    conn.close()
-
-# Initialize database at startup
-init_db()
 
-# ===== SQLite Database Functions =====
+# ===== Database Functions =====
 def load_playerdata():
-    """Load player data from SQLite database."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+    """Load player data from the configured storage backend."""
     # Get current game session
-    cursor.execute("SELECT game_code, current_game_code, start_time, end_time FROM game_sessions ORDER BY id DESC LIMIT 1")
-    session_row = cursor.fetchone()
+    session_row = storage.latest_session()
     
     result = {
         "current_game_code": None,
@@ -156,8 +638,7 @@ def load_playerdata():
         result["end_time"] = end_time
         
         # Load player sessions
-        cursor.execute("SELECT slot_id, name, token, connected, red_button_state FROM players WHERE game_code = ?", (game_code,))
-        players = cursor.fetchall()
+        players = storage.get_players(game_code)
         
         sessions = {}
         if game_code:
@@ -175,144 +656,44 @@ def load_playerdata():
         result["sessions"] = sessions
         
         # Load scores
-        cursor.execute("SELECT slot_id, round_number, round_score, total_score FROM scores WHERE game_code = ?", (game_code,))
-        scores_data = cursor.fetchall()
+        scores_data = storage.get_scores(game_code)
         
         # Initialize scores structure
         scores = {}
         for slot in valid_slots:
             scores[slot] = {
-                "rounds": [0, 0, 0, 0, 0],  # 5 rounds (including shootout)
+                "rounds": [0] * len(ROUND_NAMES),
                 "total": 0
             }
         
         # Populate scores from database
         for slot_id, round_num, round_score, total_score in scores_data:
             if slot_id in scores:
-                if 0 <= round_num < 5:  # Now supporting 5 rounds
+                if 0 <= round_num < len(ROUND_NAMES):
                     scores[slot_id]["rounds"][round_num] = round_score
                 scores[slot_id]["total"] = total_score
         
         result["scores"] = scores
     
-    conn.close()
     return result
 
 def update_game_session(game_code, current_game_code=None, start_time=None, end_time=None):
     """Update or create a game session in the database."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Check if game session already exists
-    cursor.execute("SELECT id FROM game_sessions WHERE game_code = ?", (game_code,))
-    existing = cursor.fetchone()
-    
-    if existing:
-        # Update existing session
-        cursor.execute("""
-            UPDATE game_sessions 
-            SET current_game_code = COALESCE(?, current_game_code),
-                start_time = COALESCE(?, start_time),
-                end_time = COALESCE(?, end_time)
-            WHERE game_code = ?
-        """, (current_game_code, start_time, end_time, game_code))
-    else:
-        # Create new session
-        cursor.execute("""
-            INSERT INTO game_sessions (game_code, current_game_code, start_time, end_time)
-            VALUES (?, ?, ?, ?)
-        """, (game_code, current_game_code, start_time, end_time))
-    
-    conn.commit()
-    conn.close()
+    storage.upsert_game_session(game_code, current_game_code, start_time, end_time)
 
 def update_red_button_state(game_code, slot_id, red_button_state):
     """Update the red button state for a specific player in the database."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Update the red button state for the player
-    cursor.execute("""
-        UPDATE players 
-        SET red_button_state = ?
-        WHERE game_code = ? AND slot_id = ?
-    """, (red_button_state, game_code, slot_id))
-    
-    conn.commit()
-    conn.close()
+    storage.set_red_button_state(game_code, slot_id, red_button_state)
 
 
 def update_player_session(game_code, slot_id, name=None, token=None, connected=None, red_button_state=None):
     """Update or create a player session in the database."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Check if player session already exists
-    cursor.execute("SELECT id FROM players WHERE game_code = ? AND slot_id = ?", (game_code, slot_id))
-    existing = cursor.fetchone()
-    
-    if existing:
-        # Update existing player
-        update_fields = []
-        params = []
-        
-        if name is not None:
-            update_fields.append("name = ?")
-            params.append(name)
-        if token is not None:
-            update_fields.append("token = ?")
-            params.append(token)
-        if connected is not None:
-            update_fields.append("connected = ?")
-            params.append(connected)
-        if red_button_state is not None:
-            update_fields.append("red_button_state = ?")
-            params.append(red_button_state)
-        
-        if update_fields:
-            sql = f"UPDATE players SET {', '.join(update_fields)} WHERE game_code = ? AND slot_id = ?"
-            params.extend([game_code, slot_id])
-            cursor.execute(sql, params)
-    else:
-        # Create new player
-        cursor.execute("""
-            INSERT INTO players (game_code, slot_id, name, token, connected, red_button_state)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (game_code, slot_id, name, token, connected or False, red_button_state or False))
-    
-    conn.commit()
-    conn.close()
+    storage.upsert_player(game_code, slot_id, name, token, connected, red_button_state)
 
 def update_score(game_code, slot_id, round_number, round_score=None, total_score=None, round_name=None, final_bet=None, final_bet_result=None):
     """Update or create a score record in the database."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Check if score record already exists
-    cursor.execute("SELECT id FROM scores WHERE game_code = ? AND slot_id = ? AND round_number = ?", 
-                   (game_code, slot_id, round_number))
-    existing = cursor.fetchone()
-    
-    if existing:
-        # Update existing score
-        cursor.execute("""
-            UPDATE scores 
-            SET round_score = COALESCE(?, round_score),
-                total_score = COALESCE(?, total_score),
-                round_name = COALESCE(?, round_name),
-                final_bet = COALESCE(?, final_bet),
-                final_bet_result = COALESCE(?, final_bet_result)
-            WHERE game_code = ? AND slot_id = ? AND round_number = ?
-        """, (round_score, total_score, round_name, final_bet, final_bet_result, game_code, slot_id, round_number))
-    else:
-        # Create new score record
-        cursor.execute("""
-            INSERT INTO scores (game_code, slot_id, round_number, round_name, round_score, total_score, final_bet, final_bet_result)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (game_code, slot_id, round_number, round_name, round_score or 0, total_score or 0, final_bet, final_bet_result))
-    
-    conn.commit()
-    conn.close()
+    storage.upsert_score(game_code, slot_id, round_number, round_score, total_score,
+                         round_name, final_bet, final_bet_result)
 
 
 def save_game_to_history(game_code):
@@ -325,6 +706,11 @@ def save_game_to_history(game_code):
 
 
 # ===== Утилиты =====
+def round_name(round_number):
+    if 0 <= round_number < len(ROUND_NAMES):
+        return ROUND_NAMES[round_number]
+    return f"Раунд {round_number + 1}"
+
 def generate_code():
     letters = ''.join(random.choices(string.ascii_uppercase, k=3))
     digits = ''.join(random.choices(string.digits, k=5))
@@ -334,6 +720,534 @@ def ensure_code_state(code):
     if code not in game_state:
         game_state[code] = {s: None for s in valid_slots}
 
+
+# ===== Защита от флуда =====
+class TokenBucket:
+    """Classic token bucket: ``rate`` tokens per second, at most ``capacity``."""
+
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+
+rate_buckets = {}  # { (event, scope): TokenBucket }
+flood_stats = Counter()
+flood_lock = threading.Lock()
+
+
+def allow_event(event, *scopes):
+    """Spend a token for ``event`` in every scope bucket, or count a throttle.
+
+    Scopes are the socket sid and, for registered player sockets, the
+    server-side ``(code, slot)`` pair, so one client cannot get around the
+    limit by reconnecting.
+    """
+    limit = RATE_LIMITS.get(event)
+    if not limit or not RATE_LIMITS_ENABLED:
+        return True
+    now = time.monotonic()
+    with flood_lock:
+        buckets = []
+        for scope in scopes:
+            bucket = rate_buckets.get((event, scope))
+            if bucket is None:
+                bucket = rate_buckets[(event, scope)] = TokenBucket(*limit)
+            bucket.refill(now)
+            buckets.append(bucket)
+        if all(b.tokens >= 1 for b in buckets):
+            for b in buckets:
+                b.tokens -= 1
+            return True
+        flood_stats["throttled:" + event] += 1
+    # Решение зависит от настенных часов, поэтому воспроизведение берёт его из трассы
+    if tracer.enabled and has_request_context():
+        tracer.record("throttled", sid=request.sid, event=event)
+    return False
+
+
+def drop_rate_buckets(sid):
+    with flood_lock:
+        for key in [k for k in rate_buckets if k[1] == sid]:
+            del rate_buckets[key]
+
+
+def drop_code_rate_buckets(code):
+    """Forget the ``(code, slot)`` buckets of a finished session."""
+    with flood_lock:
+        for key in [k for k in rate_buckets if isinstance(k[1], tuple) and k[1][0] == code]:
+            del rate_buckets[key]
+
+
+def player_scope(sid):
+    """``(code, slot)`` of a registered player socket, taken from the server side."""
+    info = socket_registry.get(sid) or {}
+    if info.get("role") == "player" and info.get("code") and info.get("slot"):
+        return (info["code"], info["slot"])
+    return None
+
+
+def outbound_backlog(sid):
+    """Number of packets Engine.IO has queued for ``sid`` but not yet written."""
+    try:
+        eio_sid = socketio.server.manager.eio_sid_from_sid(sid, "/")
+        eio_socket = socketio.server.eio.sockets.get(eio_sid)
+        return eio_socket.queue.qsize() if eio_socket else 0
+    except (AttributeError, NotImplementedError):
+        return 0
+
+
+def slow_sids(room):
+    return [sid for sid, info in list(socket_registry.items())
+            if info.get("code") == room and outbound_backlog(sid) > OUTBOUND_QUEUE_LIMIT]
+
+
+# Номера событий комнаты начинаются заново в каждом процессе; клиент возобновляет
+# сессию, только если номера выданы этим же запуском сервера
+BOOT_EPOCH = uuid.uuid4().hex
+
+
+class RoomBroadcaster:
+    """Coalesce outbound room events and flush them once per frame window.
+
+    Pending updates are keyed per room by ``(event, key)``, so repeated updates
+    of the same slot within one frame collapse into the latest value.
+    Latency-critical events (buzzer results) go through ``emit_now``.
+    """
+
+    def __init__(self, frame_ms):
+        self.frame = frame_ms / 1000.0
+        self.lock = threading.Lock()
+        self.pending = {}  # { room: { (event, key): payload } }
+        self.timers = {}   # { room: Timer }
+        self.deferred = {}  # { sid: { (event, key): payload } } для медленных клиентов
+        self.drain_timers = {}
+        self.seq = {}      # { room: последний номер события }
+        self.history = {}  # { room: deque[(seq, event, payload)] }
+
+    def emit(self, event, payload, room, key=None):
+        """Queue ``payload`` for ``room``; the latest value per key wins.
+
+        Without a room (handler got no game code) only the sender gets the
+        reply, as ``emit(..., room=None)`` did, not every connected client.
+        """
+        if not room:
+            self._reply(event, payload)
+            return
+        if self.frame <= 0:
+            self._send(event, payload, room)
+            return
+        with self.lock:
+            room_pending = self.pending.setdefault(room, {})
+            # Переставляем ключ в конец, чтобы сохранить порядок последних изменений
+            room_pending.pop((event, key), None)
+            room_pending[(event, key)] = payload
+            if room not in self.timers:
+                timer = threading.Timer(self.frame, self.flush, args=[room])
+                timer.daemon = True
+                self.timers[room] = timer
+                timer.start()
+
+    def emit_now(self, event, payload, room):
+        """Send immediately, after flushing what is already queued for the room."""
+        if not room:
+            self._reply(event, payload)
+            return
+        self.flush(room)
+        self._send(event, payload, room, critical=True)
+
+    @staticmethod
+    def _reply(event, payload):
+        # Из потока таймера отвечать некому
+        if has_request_context():
+            emit_client(event, payload)
+
+    def flush(self, room):
+        with self.lock:
+            timer = self.timers.pop(room, None)
+            batch = self.pending.pop(room, {})
+        if timer:
+            timer.cancel()
+        for (event, key), payload in batch.items():
+            self._send(event, payload, room, key)
+
+    def _stamp(self, event, payload, room):
+        """Number a room event and remember it for replay on resume."""
+        if not room or not isinstance(payload, dict):
+            return payload
+        with self.lock:
+            seq = self.seq.get(room, 0) + 1
+            self.seq[room] = seq
+            payload = dict(payload, seq=seq)
+            history = self.history.get(room)
+            if history is None:
+                history = self.history[room] = deque(maxlen=ROOM_HISTORY_SIZE)
+            history.append((seq, event, payload))
+        return payload
+
+    def last_seq(self, room):
+        with self.lock:
+            return self.seq.get(room, 0)
+
+    def replay(self, room, sid, last_seq):
+        """Resend events after ``last_seq`` to ``sid``; False if they are gone."""
+        with self.lock:
+            current = self.seq.get(room, 0)
+            history = list(self.history.get(room, ()))
+        if last_seq > current:
+            return False  # номера не могли быть выданы этим запуском
+        if last_seq < current and (not history or history[0][0] > last_seq + 1):
+            return False  # пропущенное уже вытеснено из кольцевого буфера
+        for seq, event, payload in history:
+            if seq > last_seq:
+                send_to_sid(sid, event, payload)
+        return True
+
+    def forget(self, sid):
+        with self.lock:
+            self.deferred.pop(sid, None)
+            timer = self.drain_timers.pop(sid, None)
+        if timer:
+            timer.cancel()
+
+    def _defer(self, sid, event, key, payload):
+        """Hold a non-critical update for a slow socket, latest value per key."""
+        with self.lock:
+            held = self.deferred.setdefault(sid, {})
+            held.pop((event, key), None)
+            held[(event, key)] = payload
+            flood_stats["deferred"] += 1
+            while len(held) > OUTBOUND_QUEUE_LIMIT:
+                held.pop(next(iter(held)))
+                flood_stats["dropped"] += 1
+            self._arm_drain(sid)
+
+    def _arm_drain(self, sid):
+        # Вызывается под self.lock
+        if sid not in self.drain_timers:
+            timer = threading.Timer(max(self.frame, 0.05), self._drain, args=[sid])
+            timer.daemon = True
+            self.drain_timers[sid] = timer
+            timer.start()
+
+    def _drain(self, sid):
+        with self.lock:
+            self.drain_timers.pop(sid, None)
+        if sid not in socket_registry:
+            self.forget(sid)
+            return
+        if outbound_backlog(sid) > OUTBOUND_QUEUE_LIMIT:
+            # Сокет всё ещё медленный: удержанное остаётся на месте, только
+            # перепланируем проверку (счётчик deferred растёт лишь от новых событий)
+            with self.lock:
+                if self.deferred.get(sid):
+                    self._arm_drain(sid)
+            return
+        with self.lock:
+            held = self.deferred.pop(sid, {})
+        for (event, _key), payload in held.items():
+            send_to_sid(sid, event, payload)
+
+    def _send(self, event, payload, room, key=None, critical=False):
+        payload = self._stamp(event, payload, room)
+        compact = COMPACT_EVENTS.get(event)
+        skip = compact_sids(room) if compact and room else []
+        slow = [] if critical or not room else slow_sids(room)
+        for sid in slow:
+            self._defer(sid, event, key, payload)
+        if not skip and not slow:
+            socketio.emit(event, payload, room=room)
+            return
+        # Старые клиенты получают JSON-словарь, новые — компактный массив
+        socketio.emit(event, payload, room=room, skip_sid=skip + slow)
+        if skip:
+            short, packed = encode_compact(event, payload)
+            socketio.emit(short, packed, room=compact_room(room),
+                          skip_sid=[sid for sid in slow if sid in skip])
+
+
+def _yellow_slots(indicators):
+    return [s for s, on in (indicators or {}).items() if on]
+
+
+# Схема c1: короткое имя события и позиционный массив вместо словаря
+COMPACT_EVENTS = {
+    "score_updated": ("su", lambda p: [p["slot"], p["total"], p["rounds"]]),
+    "player_update": ("pu", lambda p: [p["player_id"], int(bool(p["status"])), p["name"]]),
+    "admin_state": ("as", lambda p: [p["code"],
+                                     [p["slots"].get(s) for s in valid_slots],
+                                     _yellow_slots(p.get("yellowIndicators"))]),
+    "signal_triggered": ("st", lambda p: [p["blockedPlayerId"],
+                                          p["winnerPlayerId"],
+                                          _yellow_slots(p.get("yellowIndicators"))]),
+}
+
+
+def encode_compact(event, payload):
+    """Return ``(short_event, array)``; a room sequence number goes last."""
+    short, encode = COMPACT_EVENTS[event]
+    packed = encode(payload)
+    if "seq" in payload:
+        packed.append(payload["seq"])
+    return short, packed
+
+
+def client_wire(sid):
+    return (socket_registry.get(sid) or {}).get("wire")
+
+
+def compact_room(room):
+    return f"{room}:{WIRE_COMPACT}"
+
+
+def compact_sids(room):
+    # Копия: вызывается из потока таймера, пока обработчики меняют реестр
+    return [sid for sid, info in list(socket_registry.items())
+            if info.get("wire") == WIRE_COMPACT and info.get("code") == room]
+
+
+def join_code_room(code):
+    """Join the game room, plus its compact twin for clients speaking c1."""
+    join_room(code)
+    if client_wire(request.sid) == WIRE_COMPACT:
+        join_room(compact_room(code))
+
+
+def send_to_sid(sid, event, payload):
+    if event in COMPACT_EVENTS and client_wire(sid) == WIRE_COMPACT:
+        short, packed = encode_compact(event, payload)
+        socketio.emit(short, packed, room=sid)
+    else:
+        socketio.emit(event, payload, room=sid)
+
+
+def emit_client(event, payload):
+    """Reply to the current socket in the wire format it negotiated."""
+    if event in COMPACT_EVENTS and client_wire(request.sid) == WIRE_COMPACT:
+        short, packed = encode_compact(event, payload)
+        emit(short, packed)
+    else:
+        emit(event, payload)
+
+
+broadcaster = RoomBroadcaster(BROADCAST_FRAME_MS)
+
+# ===== Запись трассы =====
+class TraceRecorder:
+    """Opt-in JSON lines recorder of inbound traffic, for replay_trace.py.
+
+    Each record carries ``t`` (seconds since start) and ``kind``: ``connect``,
+    ``disconnect`` and ``ws`` for Socket.IO, ``http`` for form posts (with the
+    game code and player token the server ended up with, so the replay can
+    map them), ``throttled`` when the rate limiter dropped an event, ``timer``
+    when a server-side timer changed the game (buzzer auto-unlock), ``snapshot`` with the state every ``snapshot_seconds`` and
+    ``final`` with the state at shutdown.  A trace cut short by a crash still
+    ends with a recent snapshot to compare against.
+    """
+
+    def __init__(self, path, snapshot_seconds):
+        self.path = path
+        self.snapshot_seconds = snapshot_seconds
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.file = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def record(self, kind, **fields):
+        if not self.path:
+            return
+        fields["t"] = round(time.monotonic() - self.started, 6)
+        fields["kind"] = kind
+        line = json.dumps(fields, ensure_ascii=False, separators=(",", ":"), default=str) + "\n"
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "a", encoding="utf-8")
+                if self.snapshot_seconds > 0:
+                    threading.Thread(target=self._snapshot_loop, daemon=True).start()
+            self.file.write(line)
+            self.file.flush()
+
+    def _snapshot_loop(self):
+        while True:
+            time.sleep(self.snapshot_seconds)
+            try:
+                self.record("snapshot", state=trace_state_snapshot())
+            except Exception as e:  # снимок не должен останавливать запись
+                app.logger.warning("Снимок состояния для трассы не записан: %s", e)
+
+
+tracer = TraceRecorder(TRACE_PATH, TRACE_SNAPSHOT_SECONDS)
+
+
+def trace_client_id():
+    """Browser identity for the replay: one cookie jar per recorded client."""
+    return request.cookies.get("trace_client") or getattr(request, "trace_client", None)
+
+
+def socket_event(event):
+    """``socketio.on`` for data events that also feeds the trace recorder."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args):
+            if tracer.enabled:
+                tracer.record("ws", sid=request.sid, event=event, data=args[0] if args else None)
+            return handler(*args)
+        return socketio.on(event)(wrapper)
+    return decorator
+
+
+def trace_state_snapshot():
+    """State the replay compares against: code, scores, online slots, buzzer."""
+    pdata = load_playerdata()
+    return {
+        "code": current_game_code,
+        "scores": pdata["scores"],
+        "online": {s: info["name"] if info else None
+                   for s, info in game_state.get(current_game_code, {}).items()},
+        "signal": active_signal["player_id"] if active_signal["active"] else None,
+    }
+
+
+@app.before_request
+def trace_assign_client():
+    if tracer.enabled and not request.cookies.get("trace_client"):
+        request.trace_client = uuid.uuid4().hex
+
+
+@app.after_request
+def trace_http_post(response):
+    if not tracer.enabled:
+        return response
+    if request.method == "POST":
+        tracer.record("http", client=trace_client_id(), path=request.path,
+                      form=request.form.to_dict(), status=response.status_code,
+                      code=current_game_code, token=session.get("player_token"))
+    if not request.cookies.get("trace_client"):
+        response.set_cookie("trace_client", request.trace_client, httponly=True)
+    return response
+
+
+@atexit.register
+def trace_final_state():
+    if tracer.enabled:
+        tracer.record("final", state=trace_state_snapshot())
+
+
+def exit_on_sigterm(signum, frame):
+    # SystemExit из обработчика даёт отработать atexit (финальная запись трассы)
+    raise SystemExit(128 + signum)
+
+
+# ===== Статические ресурсы и кэш страниц =====
+asset_cache = {}  # { filename: {"body", "gzip", "br", "digest", "version", "mimetype"} }
+asset_lock = threading.Lock()
+render_cache = OrderedDict()  # { (template, context): html }
+render_lock = threading.Lock()
+
+
+def load_asset(filename):
+    """Read a file from static/ once and keep it with its compressed variants."""
+    asset = asset_cache.get(filename)
+    if asset is not None:
+        return asset
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as f:
+        body = f.read()
+    digest = hashlib.sha1(body).hexdigest()
+    asset = {
+        "body": body,
+        "gzip": gzip.compress(body, 9, mtime=0),
+        "br": brotli.compress(body, quality=11) if brotli else None,
+        "digest": digest,
+        "version": digest[:10],
+        "mimetype": mimetypes.guess_type(filename)[0] or "application/octet-stream",
+    }
+    with asset_lock:
+        asset_cache[filename] = asset
+    return asset
+
+
+def asset_url(filename):
+    """Versioned URL of a static file; falls back to the CDN for missing vendor files."""
+    asset = load_asset(filename)
+    if asset is not None:
+        return url_for("static_asset", version=asset["version"], filename=filename)
+    if filename in VENDOR_ASSETS:
+        return VENDOR_ASSETS[filename]
+    return url_for("static", filename=filename)
+
+
+app.jinja_env.globals["asset_url"] = asset_url
+
+
+@app.route("/assets/<version>/<path:filename>")
+def static_asset(version, filename):
+    asset = load_asset(filename)
+    if asset is None:
+        return {"error": "Not found"}, 404
+    if version != asset["version"]:
+        # Устаревшая ссылка: отправляем на текущую версию, а не кэшируем навсегда старую
+        return redirect(asset_url(filename))
+
+    accepted = request.accept_encodings
+    if asset["br"] is not None and accepted["br"]:
+        encoding = "br"
+    elif accepted["gzip"]:
+        encoding = "gzip"
+    else:
+        encoding = None
+    etag = f'{asset["digest"]}-{encoding or "identity"}'
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(asset[encoding] if encoding else asset["body"], mimetype=asset["mimetype"])
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+def render_cached(template_name, **context):
+    """``render_template`` that reuses finished HTML for an identical context.
+
+    Only plain GETs without pending flash messages are cached (those are the
+    only inputs besides ``context`` the templates read).  Responses carry an
+    ETag, so a reload of an unchanged page is answered with 304.
+    """
+    if request.method != "GET" or session.get("_flashes"):
+        return render_template(template_name, **context)
+    key = (template_name, tuple(sorted(context.items())))
+    with render_lock:
+        html = render_cache.get(key)
+        if html is not None:
+            render_cache.move_to_end(key)
+    if html is None:
+        html = render_template(template_name, **context)
+        with render_lock:
+            render_cache[key] = html
+            while len(render_cache) > RENDER_CACHE_SIZE:
+                render_cache.popitem(last=False)
+    response = make_response(html)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.add_etag()
+    return response.make_conditional(request)
+
+
 # ===== HTTP маршруты =====
 @app.route("/", methods=["GET", "POST"])
 def login():
@@ -397,6 +1311,9 @@ def login():
                 }
                 save_playerdata(pdata)
 
+            player_tokens.setdefault(current_game_code, {})[slot_id] = player_token
+            journal.record("token", code=current_game_code, slot=slot_id, token=player_token)
+
             session.clear()
             session["role"] = "player"
             session["player_id"] = slot_id
@@ -405,7 +1322,7 @@ def login():
             session["player_token"] = player_token
             return redirect(url_for("player", player_id=slot_id))
 
-    return render_template("login.html")
+    return render_cached("login.html")
 
 @app.route("/player/<player_id>")
 def player(player_id):
@@ -414,17 +1331,18 @@ def player(player_id):
     player_token = session.get("player_token")
     if not player_token:
         return redirect(url_for("login"))
-    return render_template("player.html",
-                           player_id=player_id,
-                           game_code=session.get("code"),
-                           player_name=session.get("player_name"),
-                           player_token=player_token)
+    return render_cached("player.html",
+                         player_id=player_id,
+                         game_code=session.get("code"),
+                         player_name=session.get("player_name"),
+                         player_token=player_token)
 
 @app.route("/admin")
 def admin():
     if session.get("role") != "admin":
         return redirect(url_for("login"))
-    return render_template("admin.html", game_code=current_game_code)
+    return render_cached("admin.html", game_code=current_game_code,
+                         round_names=tuple(ROUND_NAMES), pack_names=tuple(sorted(load_packs())))
 
 @app.route("/generate_code", methods=["POST"])
 def generate_code_route():
@@ -433,6 +1351,7 @@ def generate_code_route():
     current_game_code = code
     ensure_code_state(code)
     game_state[code] = {s: None for s in valid_slots}
+    journal.record("code", code=code)
 
     # Initialize game session in database
     update_game_session(game_code=code, current_game_code=code)
@@ -443,10 +1362,9 @@ def generate_code_route():
 
     # Initialize scores in database
     for slot in valid_slots:
-        for round_num in range(5):  # 5 rounds (including shootout)
-            round_names = ["Раунд I", "Раунд II", "Раунд III", "Финальный раунд", "Перестрелка"]
-            round_name = round_names[round_num] if round_num < len(round_names) else f"Раунд {round_num + 1}"
-            update_score(game_code=code, slot_id=slot, round_number=round_num, round_score=0, total_score=0, round_name=round_name)
+        for round_num in range(len(ROUND_NAMES)):
+            update_score(game_code=code, slot_id=slot, round_number=round_num, round_score=0, total_score=0,
+                         round_name=round_name(round_num))
 
     socketio.emit("code_updated", {"code": current_game_code})
     return redirect(url_for("admin"))
@@ -464,11 +1382,9 @@ def start_game():
         
         # Reset scores for all slots and rounds
         for slot in valid_slots:
-            for round_num in range(5):  # 5 rounds (including shootout)
-                round_names = ["Раунд I", "Раунд II", "Раунд III", "Финальный раунд", "Перестрелка"]
-                round_name = round_names[round_num] if round_num < len(round_names) else f"Раунд {round_num + 1}"
+            for round_num in range(len(ROUND_NAMES)):
                 update_score(game_code=current_game_code, slot_id=slot, 
-                           round_number=round_num, round_score=0, total_score=0, round_name=round_name)
+                           round_number=round_num, round_score=0, total_score=0, round_name=round_name(round_num))
     return redirect(url_for("admin"))
 
 @app.route("/restore_code", methods=["POST"])
@@ -479,6 +1395,7 @@ def restore_code_route():
     if code:
         current_game_code = code
         ensure_code_state(code)
+        journal.record("code", code=code)
         # Initialize if missing
         socketio.emit("code_updated", {"code": current_game_code})
     return redirect(url_for("admin"))
@@ -488,7 +1405,7 @@ def end_session():
     global current_game_code
     if current_game_code:
         room = current_game_code
-        socketio.emit("session_ended", room=room)
+        broadcaster.emit_now("session_ended", None, room=room)
         game_state[current_game_code] = {s: None for s in valid_slots}
 
         # Save game data to history before clearing
@@ -503,6 +1420,11 @@ def end_session():
         for slot in valid_slots:
             update_player_session(game_code=current_game_code, slot_id=slot, connected=False)
 
+        journal.record("end", code=current_game_code)
+        drop_code_rate_buckets(current_game_code)
+        player_tokens.pop(current_game_code, None)
+        selected_rounds.pop(current_game_code, None)
+        game_boards.pop(current_game_code, None)
         current_game_code = None
         socketio.emit("code_updated", {"code": None})
     return redirect(url_for("login"))
@@ -513,19 +1435,13 @@ def room_snapshot():
     if not code:
         return {"slots": {}}
 
-    # Load player sessions from database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT slot_id, name, connected FROM players WHERE game_code = ?", (code,))
-    players = cursor.fetchall()
-    
-    conn.close()
+    # Load player sessions from storage
+    players = storage.get_players(code)
     
     # Create snapshot dictionary
     snapshot = {s: None for s in valid_slots}
     
-    for slot_id, name, connected in players:
+    for slot_id, name, _token, connected, _red_button_state in players:
         if slot_id in valid_slots and connected:
             snapshot[slot_id] = name
 
@@ -539,18 +1455,23 @@ def logout_player():
         # Update player session in database
         update_player_session(game_code=code, slot_id=player_id, connected=False)
         
-        socketio.emit("player_update", {
+        broadcaster.emit("player_update", {
             "player_id": player_id,
             "status": False,
             "name": None
-        }, room=code)
+        }, room=code, key=player_id)
     session.clear()
     return redirect(url_for("login"))
 
 # ===== Socket.IO =====
 @socketio.on("connect")
-def on_connect():
-    socket_registry[request.sid] = {"role": None, "code": None, "slot": None}
+def on_connect(auth=None):
+    ensure_live_state()
+    tracer.record("connect", sid=request.sid, client=trace_client_id(), auth=auth)
+    wire = auth.get("wire") if isinstance(auth, dict) else None
+    if not COMPACT_WIRE_ENABLED or wire != WIRE_COMPACT:
+        wire = None
+    socket_registry[request.sid] = {"role": None, "code": None, "slot": None, "wire": wire}
 
 
 @app.route("/update_score", methods=["POST"])
@@ -580,8 +1501,75 @@ def get_player_scores():
     return {"scores": pdata["scores"], "start_time": pdata.get("start_time"), "end_time": pdata.get("end_time")}
 
 
-@socketio.on("update_player_score")
+def _parse_export_date(value):
+    if not value:
+        return None
+    time.strptime(value, "%Y-%m-%d")  # ValueError для неверного формата
+    return value
+
+
+def _export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _export_ndjson(rows):
+    batch = []
+    for row in rows:
+        batch.append(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n")
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield "".join(batch)
+            batch = []
+    yield "".join(batch)
+
+
+@app.route("/export.<fmt>")
+def export_scores(fmt):
+    """Stream score rows for one game (?code=), a date range (?from=&to=) or all games."""
+    if session.get("role") != "admin":
+        return redirect(url_for("login"))
+    if fmt not in ("csv", "ndjson"):
+        return {"error": "Формат должен быть csv или ndjson"}, 404
+    try:
+        date_from = _parse_export_date(request.args.get("from"))
+        date_to = _parse_export_date(request.args.get("to"))
+    except ValueError:
+        return {"error": "Даты указываются в формате ГГГГ-ММ-ДД"}, 400
+    code = request.args.get("code") or None
+
+    rows = storage.iter_export_rows(game_code=code, date_from=date_from, date_to=date_to)
+    # Код приходит из запроса как есть: кавычки и переводы строк сломали бы заголовок
+    filename = secure_filename(f"scores-{code or 'all'}.{fmt}") or f"scores.{fmt}"
+    if fmt == "csv":
+        body, mimetype = _export_csv(rows), "text/csv"
+    else:
+        body, mimetype = _export_ndjson(rows), "application/x-ndjson"
+    return Response(body, mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@app.route("/flood_stats")
+def flood_stats_route():
+    if session.get("role") != "admin":
+        return redirect(url_for("login"))
+    with flood_lock:
+        counters = dict(flood_stats)
+    return {"counters": counters,
+            "deferred": {sid: len(held) for sid, held in list(broadcaster.deferred.items())}}
+
+
+@socket_event("update_player_score")
 def handle_update_player_score(data):
+    if not allow_event("update_player_score", request.sid):
+        return
     slot = data.get("slot")
     points = data.get("points", 0)
     operation = data.get("operation")  # "add" or "subtract"
@@ -593,13 +1581,13 @@ def handle_update_player_score(data):
         if slot in pdata["scores"]:
             if operation == "add":
                 # Update round score if round is specified
-                if 0 <= round_number < 5:  # Now supporting 5 rounds
+                if 0 <= round_number < len(ROUND_NAMES):
                     pdata["scores"][slot]["rounds"][round_number] += points
                 # Update total score
                 pdata["scores"][slot]["total"] += points
             elif operation == "subtract":
                 # Update round score if round is specified
-                if 0 <= round_number < 5:  # Now supporting 5 rounds
+                if 0 <= round_number < len(ROUND_NAMES):
                     # Allow negative scores
                     pdata["scores"][slot]["rounds"][round_number] -= points
                 # Update total score
@@ -610,52 +1598,87 @@ def handle_update_player_score(data):
             
             # Отправляем обновленные данные всем участникам комнаты
             code = data.get("code", current_game_code)
-            emit("score_updated", {
+            broadcaster.emit("score_updated", {
                 "slot": slot,
                 "total": pdata["scores"][slot]["total"],
                 "rounds": pdata["scores"][slot]["rounds"]
-            }, room=code)
+            }, room=code, key=slot)
 
 @socketio.on("disconnect")
 def on_disconnect():
+    tracer.record("disconnect", sid=request.sid)
+    drop_rate_buckets(request.sid)
+    broadcaster.forget(request.sid)
+    clock_stats.pop(request.sid, None)
     info = socket_registry.pop(request.sid, None)
     if not info:
         return
     role, code, slot = info["role"], info["code"], info["slot"]
     if role == "player" and code and slot:
-        pdata = load_playerdata()
-        sessions = pdata.get("sessions", {})
-        if isinstance(sessions, dict) and code in sessions:
-            current_slot = sessions[code].get(slot)
-            if isinstance(current_slot, dict):
-                # Проверяем другие соединения для этого слота
-                other_connections_exist = any(
-                    v.get("role") == "player" and v.get("code") == code and v.get("slot") == slot
-                    for v in socket_registry.values()
-                )
-                if not other_connections_exist:
-                    current_slot["connected"] = False
-                    save_playerdata(pdata)
-
-        ensure_code_state(code)
-        if game_state.get(code, {}).get(slot) and game_state[code][slot]["sid"] == request.sid:
-            # Проверка других подключений в game_state (дубликатов не бывает — только socket_registry)
-            other_connections_exist = any(
-                v.get("role") == "player" and v.get("code") == code and v.get("slot") == slot
-                for v in socket_registry.values()
-            )
-            if not other_connections_exist:
-                game_state[code][slot] = None
-                emit("player_update", {"player_id": slot, "status": False, "name": None}, room=code)
+        schedule_player_leave(code, slot, request.sid)
         leave_room(code)
 
-@socketio.on("admin_join")
+
+def schedule_player_leave(code, slot, sid):
+    """Defer marking the slot offline: the phone may reconnect within the grace period."""
+    if RESUME_GRACE_SECONDS <= 0:
+        finalize_player_leave(code, slot, sid)
+        return
+    timer = threading.Timer(RESUME_GRACE_SECONDS, finalize_player_leave, args=[code, slot, sid])
+    timer.daemon = True
+    previous = pending_leaves.pop((code, slot), None)
+    if previous:
+        previous.cancel()
+    pending_leaves[(code, slot)] = timer
+    timer.start()
+
+
+def cancel_pending_leave(code, slot):
+    """Cancel a deferred disconnect; True if the slot was inside its grace period."""
+    timer = pending_leaves.pop((code, slot), None)
+    if timer:
+        timer.cancel()
+    return timer is not None
+
+
+def finalize_player_leave(code, slot, sid):
+    """Mark the slot offline unless the player came back in the meantime."""
+    pending_leaves.pop((code, slot), None)
+    # Проверяем другие соединения для этого слота
+    other_connections_exist = any(
+        v.get("role") == "player" and v.get("code") == code and v.get("slot") == slot
+        for v in list(socket_registry.values())
+    )
+    if other_connections_exist:
+        return
+
+    pdata = load_playerdata()
+    sessions = pdata.get("sessions", {})
+    if isinstance(sessions, dict) and code in sessions:
+        current_slot = sessions[code].get(slot)
+        if isinstance(current_slot, dict):
+            current_slot["connected"] = False
+            save_playerdata(pdata)
+
+    ensure_code_state(code)
+    if game_state.get(code, {}).get(slot) and game_state[code][slot]["sid"] == sid:
+        game_state[code][slot] = None
+        journal.record("leave", code=code, slot=slot)
+        broadcaster.emit("player_update", {"player_id": slot, "status": False, "name": None},
+                         room=code, key=slot)
+
+@socket_event("admin_join")
 def admin_join(data):
+    # Роль в реестре сокетов даёт права ведущего, поэтому проверяем вход администратора
+    if session.get("role") != "admin":
+        emit("join_error", {"message": "Требуется вход администратора"})
+        return
     code = data.get("code")
-    socket_registry[request.sid] = {"role": "admin", "code": code, "slot": None}
+    socket_registry[request.sid] = {"role": "admin", "code": code, "slot": None,
+                                    "wire": client_wire(request.sid)}
     if code:
         ensure_code_state(code)
-        join_room(code)
+        join_code_room(code)
         pdata = load_playerdata()
         sessions = pdata.get("sessions", {})
         if isinstance(sessions, dict) and code in sessions:
@@ -673,13 +1696,15 @@ def admin_join(data):
         if active_signal["active"] and active_signal["code"] == code:
             yellow_indicators[active_signal["player_id"]] = True
         
-        emit("admin_state", {
+        emit_client("admin_state", {
             "code": code, 
             "slots": snapshot,
             "yellowIndicators": yellow_indicators
         })
+        if code in selected_rounds:
+            emit("round_selection_confirmed", selected_rounds[code])
 
-@socketio.on("join_player")
+@socket_event("join_player")
 def handle_join_player(data):
     player_id = data.get("player_id")
     code = data.get("code")
@@ -720,6 +1745,10 @@ def handle_join_player(data):
         (token and slot_info.get("token") == token) or
         (not token and slot_info.get("name") == player_name)):
 
+        # Повторный вход в течение grace-периода (например, F5) не рассылается комнате
+        in_grace = (cancel_pending_leave(code, player_id) and slot_info is not None
+                    and slot_info.get("connected") and slot_info.get("name") == player_name)
+
         if slot_info is None:
             sessions[code][player_id] = {
                 "name": player_name,
@@ -731,7 +1760,11 @@ def handle_join_player(data):
             sessions[code][player_id]["name"] = player_name
             sessions[code][player_id]["connected"] = True
 
-        save_playerdata(pdata)
+        if not in_grace:
+            save_playerdata(pdata)
+        player_tokens.setdefault(code, {})[player_id] = sessions[code][player_id]["token"]
+        journal.record("join", code=code, slot=player_id, name=player_name,
+                       token=sessions[code][player_id]["token"])
 
         # Обновление game_state: замена старого SID
         if game_state.get(code, {}).get(player_id):
@@ -741,11 +1774,13 @@ def handle_join_player(data):
                 pass
 
         game_state[code][player_id] = {"sid": request.sid, "name": player_name}
-        socket_registry[request.sid] = {"role": "player", "code": code, "slot": player_id}
-        join_room(code)
+        socket_registry[request.sid] = {"role": "player", "code": code, "slot": player_id,
+                                        "wire": client_wire(request.sid)}
+        join_code_room(code)
+        # Точка отсчёта для возобновления: эпоха процесса и текущий номер события
+        emit("room_epoch", {"epoch": BOOT_EPOCH, "seq": broadcaster.last_seq(code)})
+        ensure_clock_sync()
 
-        emit("player_update", {"player_id": player_id, "status": True, "name": player_name}, room=code)
-        # Обновляем админов
         snapshot = {s: (pdata["sessions"][code][s]["name"]
                         if pdata["sessions"][code][s] and pdata["sessions"][code][s].get("connected")
                         else None) for s in valid_slots}
@@ -753,17 +1788,66 @@ def handle_join_player(data):
         yellow_indicators = {}
         if active_signal["active"] and active_signal["code"] == code:
             yellow_indicators[active_signal["player_id"]] = True
-        
-        emit("admin_state", {
+        state = {
             "code": code, 
             "slots": snapshot,
             "yellowIndicators": yellow_indicators
-        }, room=code)
+        }
+
+        if in_grace:
+            # Для комнаты игрок не отключался — обновляем только вошедшего
+            emit_client("admin_state", state)
+            return
+
+        broadcaster.emit("player_update", {"player_id": player_id, "status": True, "name": player_name},
+                         room=code, key=player_id)
+        # Обновляем админов
+        broadcaster.emit("admin_state", state, room=code)
     else:
         emit("join_error", {"message": "Слот недоступен"})
 
-@socketio.on("request_admin_snapshot")
+@socket_event("resume_player")
+def handle_resume_player(data):
+    """Resume a dropped player socket without a DB round-trip or room broadcast.
+
+    The client sends its token, the server epoch and the last room sequence
+    number it saw; on success only the missed room events are replayed to it.
+    Any mismatch, including numbers from an earlier server process, answers
+    ``resume_failed`` and the client falls back to ``join_player``.
+    """
+    player_id = data.get("player_id")
+    code = data.get("code")
+    token = data.get("token")
+    last_seq = data.get("last_seq")
+
+    if (data.get("epoch") != BOOT_EPOCH
+            or code is None or code != current_game_code or player_id not in valid_slots
+            or not token or player_tokens.get(code, {}).get(player_id) != token
+            or not isinstance(last_seq, int)
+            or game_state.get(code, {}).get(player_id) is None):
+        emit("resume_failed", {})
+        return
+
+    # Сначала входим в комнату, потом повторяем пропущенное: дубли безопасны, потери — нет
+    socket_registry[request.sid] = {"role": "player", "code": code, "slot": player_id,
+                                    "wire": client_wire(request.sid)}
+    join_code_room(code)
+    if not broadcaster.replay(code, request.sid, last_seq):
+        socket_registry[request.sid] = {"role": None, "code": None, "slot": None,
+                                        "wire": client_wire(request.sid)}
+        emit("resume_failed", {})
+        return
+
+    cancel_pending_leave(code, player_id)
+    game_state[code][player_id] = {"sid": request.sid, "name": game_state[code][player_id]["name"]}
+    ensure_clock_sync()
+    emit("resumed", {"epoch": BOOT_EPOCH, "seq": broadcaster.last_seq(code)})
+
+
+@socket_event("request_admin_snapshot")
 def request_admin_snapshot(data):
+    if not allow_event("request_admin_snapshot", request.sid):
+        return
     code = data.get("code")
     if not code:
         # Подготовим информацию о желтых индикаторах
@@ -771,7 +1855,7 @@ def request_admin_snapshot(data):
         if active_signal["active"] and active_signal["code"] is None:
             yellow_indicators[active_signal["player_id"]] = True
         
-        emit("admin_state", {
+        emit_client("admin_state", {
             "code": None, 
             "slots": {s: None for s in valid_slots},
             "yellowIndicators": yellow_indicators
@@ -785,7 +1869,7 @@ def request_admin_snapshot(data):
         if active_signal["active"] and active_signal["code"] == code:
             yellow_indicators[active_signal["player_id"]] = True
         
-        emit("admin_state", {
+        emit_client("admin_state", {
             "code": code, 
             "slots": {s: None for s in valid_slots},
             "yellowIndicators": yellow_indicators
@@ -799,7 +1883,7 @@ def request_admin_snapshot(data):
     if active_signal["active"] and active_signal["code"] == code:
         yellow_indicators[active_signal["player_id"]] = True
     
-    emit("admin_state", {
+    emit_client("admin_state", {
         "code": code, 
         "slots": snapshot,
         "yellowIndicators": yellow_indicators
@@ -812,10 +1896,11 @@ def request_admin_snapshot(data):
 active_signal = {
     "code": None,           # Код игры, в которой активирован сигнал
     "player_id": None,      # ID игрока, который нажал кнопку
-    "active": False         # Активен ли сигнал в данный момент
+    "active": False,        # Активен ли сигнал в данный момент
+    "started_at": None      # Время активации (time.time()) для восстановления таймера
 }
 
-@socketio.on("player_signal")
+@socket_event("player_signal")
 def handle_player_signal(data):
     global active_signal
     
@@ -823,6 +1908,13 @@ def handle_player_signal(data):
     code = data.get("code")
     player_name = data.get("name")
     token = data.get("token")
+
+    # Дешёвый отсев залипших клавиш и флуда до любых обращений к БД; ведро слота
+    # берём из реестра сокетов, а не из присланных code/player_id
+    scope = player_scope(request.sid)
+    scopes = (request.sid, scope) if scope else (request.sid,)
+    if not allow_event("player_signal", *scopes):
+        return
     
     # Проверяем, что игра активна и совпадает код
     if code != current_game_code:
@@ -832,7 +1924,7 @@ def handle_player_signal(data):
     # Проверяем, что сигнал ещё не активирован другим игроком
     if active_signal["active"] and active_signal["code"] == code:
         # Уведомляем игрока, что сигнал уже активирован
-        emit("signal_triggered", {
+        emit_client("signal_triggered", {
             "blockedPlayerId": player_id,
             "winnerPlayerId": active_signal["player_id"],
             "yellowIndicators": {active_signal["player_id"]: True}
@@ -848,29 +1940,40 @@ def handle_player_signal(data):
         emit("join_error", {"message": "Неверный токен игрока"})
         return
     
+    press_time = corrected_press_time(request.sid, data.get("pressed_at"))
+    if BUZZER_ACCEPT_WINDOW_MS <= 0:
+        activate_signal(code, player_id, player_name)
+    else:
+        submit_press(code, player_id, player_name, press_time)
+
+def activate_signal(code, player_id, player_name):
+    """Give the buzzer to ``player_id`` and tell the room right away."""
     # Активируем сигнал
     active_signal["code"] = code
     active_signal["player_id"] = player_id
     active_signal["active"] = True
+    active_signal["started_at"] = time.time()
+    journal.record("signal", code=code, slot=player_id, at=active_signal["started_at"])
     
     # Отправляем сигнал всем участникам комнаты
-    emit("player_signal_received", {
+    broadcaster.emit_now("player_signal_received", {
         "player_id": player_id,
         "name": player_name
     }, room=code)
     
     # Отправляем обновление состояния с активированным желтым индикатором
     yellow_indicators = {player_id: True}
-    emit("signal_triggered", {
+    broadcaster.emit_now("signal_triggered", {
         "blockedPlayerId": player_id,
         "winnerPlayerId": player_id,  # Добавляем идентификатор победителя
         "yellowIndicators": yellow_indicators
     }, room=code)
     
-    # Автоматическая разблокировка через 10 секунд
-    from threading import Timer
-    timer = Timer(10.0, auto_unlock_signal, args=[code])
-    timer.start()
+    # Автоматическая разблокировка через SIGNAL_AUTO_UNLOCK_SECONDS
+    if SIGNAL_AUTO_UNLOCK_SECONDS > 0:
+        from threading import Timer
+        timer = Timer(SIGNAL_AUTO_UNLOCK_SECONDS, auto_unlock_signal, args=[code])
+        timer.start()
 
 def auto_unlock_signal(code):
     global active_signal
@@ -883,17 +1986,20 @@ def auto_unlock_signal(code):
         active_signal["code"] = None
         active_signal["player_id"] = None
         active_signal["active"] = False
+        active_signal["started_at"] = None
+        journal.record("unlock", code=code)
+        tracer.record("timer", name="auto_unlock", code=code)
         
         # Reset the red button state for the player in database
         if player_id:
             update_red_button_state(game_code=code, slot_id=player_id, red_button_state=False)
 
         # Отправляем сигнал разблокировки всем участникам комнаты
-        emit("signal_unlocked", {
+        broadcaster.emit_now("signal_unlocked", {
             "players": valid_slots  # Разблокируем кнопки для всех игроков
         }, room=code)
 
-@socketio.on("admin_unlock_signal")
+@socket_event("admin_unlock_signal")
 def handle_admin_unlock_signal(data):
     global active_signal
     
@@ -906,28 +2012,573 @@ def handle_admin_unlock_signal(data):
         active_signal["code"] = None
         active_signal["player_id"] = None
         active_signal["active"] = False
+        active_signal["started_at"] = None
+        journal.record("unlock", code=code)
         
         # Отправляем сигнал разблокировки всем участникам комнаты
-        emit("signal_unlocked", {
+        broadcaster.emit_now("signal_unlocked", {
             "players": valid_slots  # Разблокируем кнопки для всех игроков
         }, room=code)
 
 
-@socketio.on("round_selected")
+@socket_event("round_selected")
 def handle_round_selected(data):
     """Handle round selection event from admin panel"""
+    if session.get("role") != "admin":
+        emit("board_error", {"message": "Требуется вход администратора"})
+        return
     code = data.get("code")
     round_number = data.get("round_number")
-    round_name = data.get("round_name")
+    # Название раунда определяет сервер, а не присланная клиентом строка
+    if not isinstance(round_number, int) or not 0 <= round_number < len(ROUND_NAMES):
+        emit("board_error", {"message": "Неизвестный раунд"})
+        return
+    name = round_name(round_number)
     
-    # We can store this information or just acknowledge the selection
-    # For now, we'll just emit an event back to confirm the round selection
-    emit("round_selection_confirmed", {
+    if code:
+        selected_rounds[code] = {"round_number": round_number, "round_name": name}
+        journal.record("round", code=code, number=round_number, name=name)
+
+    board = get_board(code) if code else None
+    broadcaster.emit("round_selection_confirmed", {
         "round_number": round_number,
-        "round_name": round_name
+        "round_name": name,
+        "board_version": board.version if board else None
     }, room=code)
 
 
+# ===== Вопросы и игровое поле =====
+class QuestionPack:
+    """A question pack loaded once into an index of cells.
+
+    ``pack.json`` holds ``{"name": ..., "rounds": [{"categories": [{"name": ...,
+    "questions": [{"value", "question", "answer", "media"}]}]}]}``; round ``i``
+    of the pack is round ``i`` of the game.  Cells are addressed by the id
+    ``"<round>-<category>-<question>"``, so a lookup is a single dict access.
+    """
+
+    def __init__(self, name, directory, data):
+        self.name = name
+        self.directory = directory
+        self.title = data.get("name") or name
+        self.cells = {}   # { cell_id: cell }
+        self.rounds = []  # [ [ {"name":..., "cells": [cell_id, ...]} ] ]
+        self.media = set()  # файлы, на которые ссылаются вопросы; только их отдаёт /media
+        for r, rnd in enumerate(data.get("rounds", [])):
+            categories = []
+            for c, category in enumerate(rnd.get("categories", [])):
+                cell_ids = []
+                for q, question in enumerate(category.get("questions", [])):
+                    cell_id = f"{r}-{c}-{q}"
+                    media = question.get("media")
+                    if media:
+                        self.media.add(media)
+                    self.cells[cell_id] = {
+                        "id": cell_id,
+                        "round": r,
+                        "category": category["name"],
+                        "value": int(question["value"]),
+                        "question": question.get("question", ""),
+                        "answer": question.get("answer", ""),
+                        "media": f"/media/{quote(name)}/{quote(media)}" if media else None,
+                    }
+                    cell_ids.append(cell_id)
+                categories.append({"name": category["name"], "cells": cell_ids})
+            self.rounds.append(categories)
+
+
+class GameBoard:
+    """Which cells of a pack are used in one game, plus cached board payloads.
+
+    ``version`` grows with every selected cell; payloads are rendered to JSON
+    once per (round, view, version) and reused for every client until then.
+    A new board (pack reload, restart) starts counting again, so ETags also
+    carry a per-board ``nonce``.
+    """
+
+    def __init__(self, code, pack):
+        self.code = code
+        self.pack = pack
+        self.used = set()
+        self.version = 0
+        self.nonce = uuid.uuid4().hex[:8]
+        self.lock = threading.Lock()
+        self.cache = {}  # { (round, view): (version, body, etag) }
+
+    def select(self, cell_id):
+        """Mark a cell as used; returns the cell, or None if unknown or already used."""
+        cell = self.pack.cells.get(cell_id)
+        with self.lock:
+            if cell is None or cell_id in self.used:
+                return None
+            self.used.add(cell_id)
+            self.version += 1
+        return cell
+
+    def restore(self, used):
+        with self.lock:
+            self.used.update(c for c in used if c in self.pack.cells)
+            self.version = len(self.used)
+
+    def payload(self, round_number, view):
+        """Return ``(body, etag)`` of the board for a round of the pack; host view includes answers."""
+        key = (round_number, view)
+        with self.lock:
+            version = self.version
+            cached = self.cache.get(key)
+            if cached and cached[0] == version:
+                return cached[1], cached[2]
+            used = set(self.used)
+        categories = self.pack.rounds[round_number]
+        board = {
+            "pack": self.pack.title,
+            "round_number": round_number,
+            "round_name": round_name(round_number),
+            "version": version,
+            "categories": [],
+        }
+        for category in categories:
+            cells = []
+            for cell_id in category["cells"]:
+                cell = self.pack.cells[cell_id]
+                item = {"id": cell_id, "value": cell["value"], "used": cell_id in used}
+                if view == "host":
+                    item.update(question=cell["question"], answer=cell["answer"], media=cell["media"])
+                cells.append(item)
+            board["categories"].append({"name": category["name"], "cells": cells})
+        body = json.dumps(board, ensure_ascii=False, separators=(",", ":"))
+        etag = f"{self.code}-{self.nonce}-{round_number}-{view}-{version}"
+        with self.lock:
+            self.cache[key] = (version, body, etag)
+        return body, etag
+
+
+question_packs = None  # { name: QuestionPack }, загружаются один раз
+packs_lock = threading.Lock()
+game_boards = {}  # { code: GameBoard }
+
+
+def load_packs():
+    global question_packs
+    if question_packs is not None:
+        return question_packs
+    with packs_lock:
+        if question_packs is None:
+            packs = {}
+            if os.path.isdir(PACKS_DIR):
+                for name in sorted(os.listdir(PACKS_DIR)):
+                    directory = os.path.join(PACKS_DIR, name)
+                    path = os.path.join(directory, "pack.json")
+                    if not os.path.isfile(path):
+                        continue
+                    try:
+                        with open(path, encoding="utf-8") as f:
+                            packs[name] = QuestionPack(name, directory, json.load(f))
+                    except (OSError, ValueError, KeyError, TypeError) as e:
+                        app.logger.warning("Пакет вопросов %s пропущен: %s", path, e)
+            question_packs = packs
+    return question_packs
+
+
+def get_board(code, pack_name=None):
+    """Board of a game, created on first use with the requested or default pack."""
+    board = game_boards.get(code)
+    if board is not None and (pack_name is None or board.pack.name == pack_name):
+        return board
+    packs = load_packs()
+    if pack_name is None:
+        pack_name = QUESTION_PACK if QUESTION_PACK in packs else next(iter(packs), None)
+    if pack_name not in packs:
+        return None
+    board = game_boards[code] = GameBoard(code, packs[pack_name])
+    return board
+
+
+@app.route("/board/<code>")
+def board_route(code):
+    """Cached board payload for ``?round=N``; ``?view=host`` (admins) adds answers."""
+    view = "host" if request.args.get("view") == "host" else "public"
+    if view == "host" and session.get("role") != "admin":
+        return redirect(url_for("login"))
+    # Чтение не создаёт полей: только текущая игра или уже заведённое поле
+    board = game_boards.get(code) or (get_board(code) if code == current_game_code else None)
+    if board is None:
+        return {"error": "Пакет вопросов не загружен"}, 404
+    round_number = request.args.get("round", type=int)
+    if round_number is None:
+        round_number = selected_rounds.get(code, {}).get("round_number") or 0
+    # Кэш поля хранит запись на каждый раунд: неизвестные раунды в него не попадают
+    if not 0 <= round_number < len(board.pack.rounds):
+        return {"error": "В пакете нет такого раунда"}, 404
+    body, etag = board.payload(round_number, view)
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
+
+
+@app.route("/media/<pack>/<path:filename>")
+def pack_media(pack, filename):
+    """Media of a pack; send_from_directory answers Range requests for large files."""
+    question_pack = load_packs().get(pack)
+    # Каталог пакета содержит и pack.json с ответами — отдаём только объявленные медиафайлы
+    if question_pack is None or filename not in question_pack.media:
+        return {"error": "Not found"}, 404
+    return send_from_directory(os.path.abspath(question_pack.directory), filename,
+                               conditional=True, max_age=MEDIA_MAX_AGE)
+
+
+@socket_event("board_load_pack")
+def handle_board_load_pack(data):
+    if session.get("role") != "admin":
+        emit("board_error", {"message": "Требуется вход администратора"})
+        return
+    code = data.get("code")
+    pack_name = data.get("pack")
+    if not code or pack_name not in load_packs():
+        emit("board_error", {"message": "Пакет вопросов не найден"})
+        return
+    game_boards.pop(code, None)
+    board = get_board(code, pack_name)
+    journal.record("board", code=code, pack=pack_name)
+    broadcaster.emit_now("board_changed", {"pack": board.pack.title, "version": board.version}, room=code)
+
+
+@socket_event("select_cell")
+def handle_select_cell(data):
+    """Host opens a question: O(1) lookup, mark used, tell the room."""
+    if session.get("role") != "admin":
+        emit("board_error", {"message": "Требуется вход администратора"})
+        return
+    code = data.get("code")
+    board = get_board(code) if code else None
+    cell = board.select(data.get("cell")) if board else None
+    if cell is None:
+        emit("board_error", {"message": "Вопрос недоступен"})
+        return
+    journal.record("cell", code=code, pack=board.pack.name, cell=cell["id"])
+    broadcaster.emit_now("cell_selected", {
+        "cell": cell["id"],
+        "category": cell["category"],
+        "value": cell["value"],
+        "question": cell["question"],
+        "media": cell["media"],
+        "version": board.version
+    }, room=code)
+    # Ответ видит только ведущий
+    emit("cell_answer", {"cell": cell["id"], "answer": cell["answer"]})
+
+
+# ===== Синхронизация часов и арбитраж кнопки =====
+def now_ms():
+    return time.time() * 1000.0
+
+
+class ClockEstimator:
+    """Rolling RTT / clock-offset estimate for one socket.
+
+    Offset is ``client_clock - server_clock`` in ms, taken from the sample with
+    the lowest RTT (the one least distorted by queueing), as NTP does.
+    """
+
+    def __init__(self):
+        self.samples = deque(maxlen=CLOCK_SAMPLES)  # [(rtt, offset)]
+
+    def add(self, rtt, offset):
+        self.samples.append((rtt, offset))
+
+    # add() вызывается из потока ответа на пинг, чтение — из обработчиков и цикла
+    # синхронизации, поэтому работаем с копией, а не итерируем сам deque
+
+    @property
+    def offset(self):
+        samples = list(self.samples)
+        return min(samples)[1] if samples else None
+
+    def stats(self):
+        samples = list(self.samples)
+        if not samples:
+            return None
+        rtts = sorted(rtt for rtt, _ in samples)
+        return {"rtt": round(rtts[len(rtts) // 2]),
+                "rtt_min": round(rtts[0]),
+                "jitter": round(rtts[-1] - rtts[0]),
+                "offset": round(min(samples)[1]),
+                "samples": len(rtts)}
+
+
+clock_stats = {}  # { sid: ClockEstimator }
+clock_sync_started = False
+clock_sync_lock = threading.Lock()
+buzzer_windows = {}  # { code: [(press_time, player_id, name)] } — открытые окна арбитража
+buzzer_lock = threading.Lock()
+
+
+def ensure_clock_sync():
+    global clock_sync_started
+    with clock_sync_lock:
+        if clock_sync_started:
+            return
+        clock_sync_started = True
+    socketio.start_background_task(clock_sync_loop)
+
+
+def clock_sync_loop():
+    """Ping every player socket periodically and push RTT stats to the hosts."""
+    while True:
+        socketio.sleep(CLOCK_SYNC_INTERVAL)
+        rooms = {}
+        for sid, info in list(socket_registry.items()):
+            if info.get("role") == "player":
+                sent = now_ms()
+                socketio.emit("clock_ping", {"s": sent}, room=sid,
+                              callback=lambda pong, sid=sid, sent=sent: on_clock_pong(sid, sent, pong))
+                estimator = clock_stats.get(sid)
+                if estimator and estimator.samples:
+                    rooms.setdefault(info["code"], {})[info["slot"]] = estimator.stats()
+        for sid, info in list(socket_registry.items()):
+            if info.get("role") == "admin" and info.get("code") in rooms:
+                socketio.emit("clock_stats", {"slots": rooms[info["code"]]}, room=sid)
+
+
+def on_clock_pong(sid, sent, pong):
+    received = now_ms()
+    client_time = pong.get("c") if isinstance(pong, dict) else None
+    if not isinstance(client_time, (int, float)) or sid not in socket_registry:
+        return
+    rtt = received - sent
+    clock_stats.setdefault(sid, ClockEstimator()).add(rtt, client_time - (sent + rtt / 2))
+
+
+def corrected_press_time(sid, pressed_at):
+    """Translate a client press timestamp to server time, within the allowed bound."""
+    received = now_ms()
+    estimator = clock_stats.get(sid)
+    if not isinstance(pressed_at, (int, float)) or not estimator or estimator.offset is None:
+        return received
+    corrected = pressed_at - estimator.offset
+    # Нельзя нажать в будущем или раньше, чем позволяет окно компенсации
+    return min(received, max(corrected, received - BUZZER_MAX_COMPENSATION_MS))
+
+
+def submit_press(code, player_id, player_name, press_time):
+    """Collect a press into the arbitration window of ``code``, opening it if needed."""
+    with buzzer_lock:
+        presses = buzzer_windows.get(code)
+        if presses is None:
+            presses = buzzer_windows[code] = []
+            timer = threading.Timer(BUZZER_ACCEPT_WINDOW_MS / 1000.0, close_buzzer_window, args=[code])
+            timer.daemon = True
+            timer.start()
+        if all(p[1] != player_id for p in presses):
+            presses.append((press_time, player_id, player_name))
+
+
+def close_buzzer_window(code):
+    with buzzer_lock:
+        presses = buzzer_windows.pop(code, [])
+    if not presses or (active_signal["active"] and active_signal["code"] == code):
+        return
+    _press_time, player_id, player_name = min(presses)
+    activate_signal(code, player_id, player_name)
+
+
+# ===== Журнал живого состояния =====
+def empty_live_state():
+    return {"code": None, "signal": None, "rounds": {}, "online": {}, "tokens": {}, "boards": {}}
+
+
+def apply_journal_entry(state, entry):
+    """Apply one journal record to a live-state dict; records are idempotent."""
+    op = entry.get("op")
+    code = entry.get("code")
+    if op == "code":
+        state["code"] = code
+    elif op == "end":
+        if state["code"] == code:
+            state["code"] = None
+        for key in ("rounds", "online", "tokens", "boards"):
+            state[key].pop(code, None)
+        if state["signal"] and state["signal"]["code"] == code:
+            state["signal"] = None
+    elif op == "token":
+        state["tokens"].setdefault(code, {})[entry["slot"]] = entry["token"]
+    elif op == "join":
+        state["online"].setdefault(code, {})[entry["slot"]] = entry["name"]
+        state["tokens"].setdefault(code, {})[entry["slot"]] = entry["token"]
+    elif op == "leave":
+        state["online"].get(code, {}).pop(entry["slot"], None)
+    elif op == "signal":
+        state["signal"] = {"code": code, "slot": entry["slot"], "at": entry["at"]}
+    elif op == "unlock":
+        if state["signal"] and state["signal"]["code"] == code:
+            state["signal"] = None
+    elif op == "round":
+        state["rounds"][code] = {"round_number": entry["number"], "round_name": entry["name"]}
+    elif op == "board":
+        state["boards"][code] = {"pack": entry["pack"], "used": []}
+    elif op == "cell":
+        board = state["boards"].setdefault(code, {"pack": entry.get("pack"), "used": []})
+        if entry["cell"] not in board["used"]:
+            board["used"].append(entry["cell"])
+    return state
+
+
+class LiveJournal:
+    """Append-only journal of live-state changes with periodic checkpoints.
+
+    Scores and player sessions are already in the database; the journal
+    covers what used to live only in memory: the current code, the active
+    buzzer, the selected round, connected slots and player tokens.  The
+    journal keeps its own replayed copy of that state, so a checkpoint is
+    always consistent with the records written before it.
+    """
+
+    def __init__(self, path, checkpoint_path, checkpoint_every):
+        self.path = path
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.lock = threading.Lock()
+        self.state = empty_live_state()
+        self.file = None
+        self.entries = 0
+
+    def record(self, op, **fields):
+        if not self.path:
+            return
+        fields["op"] = op
+        line = json.dumps(fields, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self.lock:
+            apply_journal_entry(self.state, fields)
+            if self.file is None:
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write(line)
+            self.file.flush()
+            self.entries += 1
+            if self.entries >= self.checkpoint_every:
+                self._checkpoint()
+
+    def load(self):
+        """Rebuild the live state from the last checkpoint plus the journal tail."""
+        state = empty_live_state()
+        if not self.path:
+            return state
+        try:
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                state.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        has_tail = False
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    has_tail = True
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # оборванная последняя запись после сбоя
+                    apply_journal_entry(state, entry)
+        except OSError:
+            pass
+        with self.lock:
+            self.state = state
+            # Снимок нужен, только если журнал не пуст: иначе состояние уже в снимке
+            if has_tail:
+                self._checkpoint()
+        return state
+
+    def _checkpoint(self):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        # Записи до снимка больше не нужны
+        if self.file:
+            self.file.close()
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.entries = 0
+
+
+journal = LiveJournal(JOURNAL_PATH, CHECKPOINT_PATH, CHECKPOINT_EVERY)
+
+
+def restore_live_state():
+    """Rebuild in-memory game state after a restart; returns elapsed seconds."""
+    global current_game_code
+    started = time.perf_counter()
+    state = journal.load()
+
+    # Игры, которых нет в хранилище (например, память после перезапуска), не
+    # восстанавливаем: очки и сессии для них уже не найти
+    stored = {}
+
+    def known(code):
+        if code not in stored:
+            stored[code] = bool(storage.get_players(code))
+        return stored[code]
+
+    current_game_code = state["code"] if state["code"] and known(state["code"]) else None
+    selected_rounds.update((code, rnd) for code, rnd in state["rounds"].items() if known(code))
+    for code, tokens in state["tokens"].items():
+        if known(code):
+            player_tokens.setdefault(code, {}).update(tokens)
+    for code, online in state["online"].items():
+        if not known(code):
+            continue
+        ensure_code_state(code)
+        for slot, name in online.items():
+            # Старые sid недействительны: слот ждёт переподключения, как после обрыва
+            game_state[code][slot] = {"sid": None, "name": name}
+            schedule_player_leave(code, slot, None)
+
+    for code, saved in state["boards"].items():
+        if not known(code):
+            continue
+        board = get_board(code, saved["pack"])
+        if board is not None:
+            board.restore(saved["used"])
+
+    signal = state["signal"]
+    if signal and known(signal["code"]):
+        active_signal.update(code=signal["code"], player_id=signal["slot"],
+                             active=True, started_at=signal["at"])
+        if SIGNAL_AUTO_UNLOCK_SECONDS > 0:
+            remaining = SIGNAL_AUTO_UNLOCK_SECONDS - (time.time() - signal["at"])
+            timer = threading.Timer(max(remaining, 0.0), auto_unlock_signal, args=[signal["code"]])
+            timer.daemon = True
+            timer.start()
+    return time.perf_counter() - started
+
+
+live_state_restored = False
+live_state_lock = threading.Lock()
+
+
+def ensure_live_state():
+    """Restore the journaled state once, at startup or on the first request."""
+    global live_state_restored
+    if live_state_restored:
+        return
+    with live_state_lock:
+        if not live_state_restored:
+            elapsed = restore_live_state()
+            live_state_restored = True
+            # Строку разбирает bench_startup.py
+            print(f"restore_live_state: {elapsed * 1000:.1f} ms", file=sys.stderr, flush=True)
+
+
+@app.before_request
+def restore_before_request():
+    ensure_live_state()
+
+
 # ===== Запуск =====
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=21365)
\ No newline at end of file
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    ensure_live_state()
+    # Встроенный сервер Werkzeug отказывается стартовать без терминала (под супервизором),
+    # если не разрешить это явно; в режиме threading другого сервера у приложения нет
+    socketio.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", "21365")),
+                 allow_unsafe_werkzeug=True)
\ No newline at end of file
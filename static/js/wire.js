@@ -0,0 +1,47 @@
+// Компактный формат сообщений "c1": для частых событий сервер присылает
+// позиционные массивы под короткими именами. Здесь они разворачиваются
+// обратно в обычные объекты и передаются существующим обработчикам.
+const WIRE_FORMAT = "c1";
+const WIRE_SLOTS = ["1", "2", "3"];
+
+function wireYellow(slots) {
+  const indicators = {};
+  (slots || []).forEach(s => { indicators[s] = true; });
+  return indicators;
+}
+
+const WIRE_DECODERS = {
+  su: ["score_updated", a => ({ slot: a[0], total: a[1], rounds: a[2], seq: a[3] })],
+  pu: ["player_update", a => ({ player_id: a[0], status: !!a[1], name: a[2], seq: a[3] })],
+  as: ["admin_state", a => ({
+    code: a[0],
+    slots: Object.fromEntries(WIRE_SLOTS.map((s, i) => [s, a[1][i]])),
+    yellowIndicators: wireYellow(a[2]),
+    seq: a[3]
+  })],
+  st: ["signal_triggered", a => ({
+    blockedPlayerId: a[0],
+    winnerPlayerId: a[1],
+    yellowIndicators: wireYellow(a[2]),
+    seq: a[3]
+  })]
+};
+
+// Номер события комнаты: поле seq в JSON или последний элемент массива c1
+function wireSeq(data) {
+  if (Array.isArray(data)) return data.length > 3 ? data[3] : null;
+  return data && typeof data.seq === "number" ? data.seq : null;
+}
+
+// Подключение с запросом компактного формата; сервер без его поддержки
+// просто продолжит слать JSON-словари под обычными именами событий.
+function connectSocket() {
+  const socket = io({ auth: { wire: WIRE_FORMAT } });
+  Object.entries(WIRE_DECODERS).forEach(([short, [event, decode]]) => {
+    socket.on(short, a => {
+      const data = decode(a);
+      socket.listeners(event).forEach(fn => fn(data));
+    });
+  });
+  return socket;
+}
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Настройки читаются при импорте server: без диска, журнала, трассы и фоновых пингов
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("JOURNAL_PATH", "")
+os.environ.setdefault("TRACE_PATH", "")
+os.environ.setdefault("CLOCK_SYNC_INTERVAL", "3600")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
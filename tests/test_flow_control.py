@@ -0,0 +1,174 @@
+"""Token buckets, per-frame coalescing and resume replay of RoomBroadcaster."""
+import pytest
+
+import server
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Manual ``time.monotonic`` for the rate limiter."""
+    now = [1000.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture(autouse=True)
+def clean_flood_state():
+    server.rate_buckets.clear()
+    server.flood_stats.clear()
+    yield
+    server.rate_buckets.clear()
+    server.flood_stats.clear()
+
+
+def test_bucket_refills_at_rate_up_to_capacity(clock):
+    bucket = server.TokenBucket(rate=2.0, capacity=4)
+    bucket.tokens = 0
+    bucket.stamp = clock[0]
+
+    bucket.refill(clock[0] + 0.5)
+    assert bucket.tokens == pytest.approx(1.0)
+
+    bucket.refill(clock[0] + 100)
+    assert bucket.tokens == 4
+
+
+def test_allow_event_throttles_after_burst_and_recovers(clock, monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, "player_signal", (5.0, 5))
+
+    assert all(server.allow_event("player_signal", "sid-1") for _ in range(5))
+    assert not server.allow_event("player_signal", "sid-1")
+    assert server.flood_stats["throttled:player_signal"] == 1
+
+    # Другие сокеты тратят свои вёдра
+    assert server.allow_event("player_signal", "sid-2")
+
+    clock[0] += 0.2  # один токен при 5 в секунду
+    assert server.allow_event("player_signal", "sid-1")
+    assert not server.allow_event("player_signal", "sid-1")
+
+
+def test_allow_event_needs_a_token_in_every_scope(clock, monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, "player_signal", (1.0, 2))
+    slot = ("CODE", "1")
+
+    assert server.allow_event("player_signal", "sid-1", slot)
+    assert server.allow_event("player_signal", "sid-1", slot)
+    # Переподключение даёт новый sid, но ведро слота уже пусто
+    assert not server.allow_event("player_signal", "sid-2", slot)
+    # Отказ не списывает токен из ведра нового сокета
+    assert server.rate_buckets[("player_signal", "sid-2")].tokens == 2
+
+
+def test_rate_limits_can_be_switched_off(clock, monkeypatch):
+    monkeypatch.setitem(server.RATE_LIMITS, "player_signal", (1.0, 1))
+    monkeypatch.setattr(server, "RATE_LIMITS_ENABLED", False)
+    assert all(server.allow_event("player_signal", "sid-1") for _ in range(10))
+    assert not server.rate_buckets
+
+
+def test_drop_code_rate_buckets_forgets_finished_session(clock):
+    server.allow_event("player_signal", "sid-1", ("OLD", "1"))
+    server.allow_event("player_signal", "sid-2", ("NEW", "1"))
+
+    server.drop_code_rate_buckets("OLD")
+
+    assert ("player_signal", ("OLD", "1")) not in server.rate_buckets
+    assert ("player_signal", ("NEW", "1")) in server.rate_buckets
+
+
+class RecordingBroadcaster(server.RoomBroadcaster):
+    """Broadcaster that records what it would send instead of emitting."""
+
+    def __init__(self, frame_ms):
+        super().__init__(frame_ms)
+        self.sent = []
+
+    def _send(self, event, payload, room, key=None, critical=False):
+        self.sent.append((event, key, self._stamp(event, payload, room)))
+
+
+def test_latest_value_per_key_wins_within_a_frame():
+    broadcaster = RecordingBroadcaster(frame_ms=10_000)
+    for total in (100, 200, 300):
+        broadcaster.emit("score_updated", {"slot": "1", "total": total}, room="ROOM", key="1")
+    broadcaster.emit("score_updated", {"slot": "2", "total": 50}, room="ROOM", key="2")
+    broadcaster.emit("score_updated", {"slot": "1", "total": 400}, room="ROOM", key="1")
+
+    assert broadcaster.sent == []
+    broadcaster.flush("ROOM")
+
+    # Слот 1 обновлён последним, поэтому уходит после слота 2
+    assert [(key, payload["total"]) for _, key, payload in broadcaster.sent] == [("2", 50), ("1", 400)]
+    assert [payload["seq"] for _, _, payload in broadcaster.sent] == [1, 2]
+
+
+def test_emit_now_flushes_queued_updates_first():
+    broadcaster = RecordingBroadcaster(frame_ms=10_000)
+    broadcaster.emit("score_updated", {"slot": "1", "total": 100}, room="ROOM", key="1")
+    broadcaster.emit_now("signal_unlocked", {"players": ["1"]}, room="ROOM")
+
+    assert [event for event, _, _ in broadcaster.sent] == ["score_updated", "signal_unlocked"]
+
+
+def test_rooms_are_coalesced_separately():
+    broadcaster = RecordingBroadcaster(frame_ms=10_000)
+    broadcaster.emit("admin_state", {"code": "A"}, room="A")
+    broadcaster.emit("admin_state", {"code": "B"}, room="B")
+
+    broadcaster.flush("A")
+
+    assert [payload["code"] for _, _, payload in broadcaster.sent] == ["A"]
+    broadcaster.flush("B")
+
+
+@pytest.fixture
+def replayed(monkeypatch):
+    sent = []
+    monkeypatch.setattr(server, "send_to_sid", lambda sid, event, payload: sent.append(payload["seq"]))
+    return sent
+
+
+def fill_history(broadcaster, room, count):
+    for n in range(count):
+        broadcaster._stamp("admin_state", {"n": n}, room)
+
+
+def test_replay_resends_only_missed_events(monkeypatch, replayed):
+    monkeypatch.setattr(server, "ROOM_HISTORY_SIZE", 8)
+    broadcaster = server.RoomBroadcaster(0)
+    fill_history(broadcaster, "ROOM", 5)
+
+    assert broadcaster.replay("ROOM", "sid", 3)
+    assert replayed == [4, 5]
+
+
+def test_replay_with_nothing_missed_sends_nothing(monkeypatch, replayed):
+    monkeypatch.setattr(server, "ROOM_HISTORY_SIZE", 8)
+    broadcaster = server.RoomBroadcaster(0)
+    fill_history(broadcaster, "ROOM", 5)
+
+    assert broadcaster.replay("ROOM", "sid", 5)
+    assert replayed == []
+
+
+def test_replay_fails_once_missed_events_are_evicted(monkeypatch, replayed):
+    monkeypatch.setattr(server, "ROOM_HISTORY_SIZE", 4)
+    broadcaster = server.RoomBroadcaster(0)
+    fill_history(broadcaster, "ROOM", 10)  # в буфере остались 7..10
+
+    assert broadcaster.replay("ROOM", "sid", 6)
+    assert replayed == [7, 8, 9, 10]
+
+    replayed.clear()
+    assert not broadcaster.replay("ROOM", "sid", 5)  # событие 6 уже вытеснено
+    assert replayed == []
+
+
+def test_replay_rejects_numbers_ahead_of_the_room(monkeypatch, replayed):
+    monkeypatch.setattr(server, "ROOM_HISTORY_SIZE", 8)
+    broadcaster = server.RoomBroadcaster(0)
+    fill_history(broadcaster, "ROOM", 3)
+
+    assert not broadcaster.replay("ROOM", "sid", 7)
+    assert replayed == []
@@ -0,0 +1,8 @@
+"""Vendor libraries the pages need, shared by server.py and fetch_assets.py."""
+
+# Локальные копии внешних библиотек (скачиваются fetch_assets.py в static/);
+# пока файла нет, страница ссылается на CDN
+VENDOR_ASSETS = {
+    "vendor/bootstrap.min.css": "https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css",
+    "vendor/socket.io.min.js": "https://cdn.socket.io/4.5.4/socket.io.min.js",
+}